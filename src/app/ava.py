@@ -1,5 +1,21 @@
+import os
+import json
+import asyncio
+import hashlib
+import random
 import requests
-from time import sleep
+import threading
+import client
+from cache import TranscriptCache, UserCache, ExportCache
+from metrics import esp_request_seconds, esp_errors_total
+from time import time, monotonic, perf_counter, sleep
+from collections import deque
+from queue import Queue, Full
+from itertools import islice
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from urllib.parse import urlparse, parse_qs, urlencode
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -17,19 +33,102 @@ live_agents = {
     "tenant4dev": 14
 }
 
+# Max number of conversations fetched at the same time in a reporting job
+max_in_flight = {
+    "devdev": 4,
+    "tenant1": 8,
+    "tenant1dev": 4,
+    "tenant2": 8,
+    "tenant2dev": 4,
+    "tenant3": 8,
+    "tenant3dev": 4,
+    "tenant4": 8,
+    "tenant4dev": 4
+}
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# Max number of ESP requests in flight at the same time across all tenants and jobs
+ESP_MAX_IN_FLIGHT = int(os.getenv("ESP_MAX_IN_FLIGHT", "32"))
+
+# Max number of pages of a configuration export fetched at the same time
+PAGINATION_MAX_IN_FLIGHT = int(os.getenv("PAGINATION_MAX_IN_FLIGHT", "4"))
+
+# ESP async exports are polled with exponential backoff, from EXPORT_POLL_INITIAL up to
+# EXPORT_POLL_MAX seconds between polls, and given up after EXPORT_POLL_DEADLINE seconds
+EXPORT_POLL_INITIAL = 1.0
+EXPORT_POLL_MAX = 15.0
+EXPORT_POLL_DEADLINE = 600
+
+# Number of interactions requested per GraphQL cursor page
+GRAPHQL_PAGE_SIZE = 500
+
+# Conversations of a bulk transcript export whose users are resolved together
+TRANSCRIPT_BATCH_SIZE = 100
+
+# Date ranges wider than GRAPHQL_SHARD_DAYS are queried in shards of that many days, GRAPHQL_SHARD_MAX_IN_FLIGHT
+# at a time, and a failed shard is fetched again up to GRAPHQL_SHARD_RETRIES times. Shards fetched ahead of the
+# one being yielded hold at most GRAPHQL_SHARD_BUFFER_PAGES pages each
+GRAPHQL_SHARD_DAYS = int(os.getenv("GRAPHQL_SHARD_DAYS", "1"))
+GRAPHQL_SHARD_MAX_IN_FLIGHT = int(os.getenv("GRAPHQL_SHARD_MAX_IN_FLIGHT", "4"))
+GRAPHQL_SHARD_RETRIES = int(os.getenv("GRAPHQL_SHARD_RETRIES", "2"))
+GRAPHQL_SHARD_BUFFER_PAGES = int(os.getenv("GRAPHQL_SHARD_BUFFER_PAGES", "4"))
+
+# Base URL of a tenant's ESP instance, {tenant} is replaced with the tenant name
+ESP_URL = os.getenv("ESP_URL", "https://{tenant}.esp.com")
+
+# Columns of a reporting row, in the order the GraphQL query selects them
+INTERACTION_FIELDS = (
+    "creation", "eid", "interactionText", "cleanInteractionText", "noResponse", "userName",
+    "userJobRole", "userDepartment", "userLocation", "city", "state", "country",
+    "matchedArchetypeIntent", "actualMatchedIntent", "actualMatchedApplication",
+    "actualMatchedApplicationType", "intentReviewed", "source", "caseReference",
+    "espServiceDepartment", "espCategory", "espServiceTeam", "serviceDepartment",
+    "serviceDepartmentClassification", "helpfulFeedback", "taskFeedback", "supportFeedback",
+    "deflected", "possiblyAbandoned", "channel", "os", "client", "isoCountryCode",
+    "conversationChannel", "kbResponse", "userLanguage",
+    "actualMatchedIntentReportingLabel", "matchedArchetypeIntentReportingLabel", "severity",
+    "keywords", "automationStatus"
+)
+
+# Columns a reporting job can be asked for, a projection keeps this order
+REPORT_COLUMNS = INTERACTION_FIELDS + ("transcript",)
+# Fields the job pipeline reads, selected even when they aren't reported
+PIPELINE_FIELDS = ("creation", "eid", "deflected", "conversationChannel", "userName")
+
+# ESP tokens are reused for TOKEN_TTL seconds and refreshed TOKEN_REFRESH_MARGIN seconds before that
+TOKEN_TTL = 3600
+TOKEN_REFRESH_MARGIN = 300
+
+# Messages of conversations seen by earlier jobs are read from a local cache
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+TRANSCRIPT_CACHE_MAX_BYTES = int(
+    os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TRANSCRIPT_CACHE_SETTLE_SECONDS = int(
+    os.getenv("TRANSCRIPT_CACHE_SETTLE_SECONDS", "3600"))
+# Configuration exports are served from the cache for EXPORT_CACHE_FRESH_SECONDS, then revalidated
+# against the first page of the resource, and fetched again in full after EXPORT_CACHE_TTL seconds
+EXPORT_CACHE_FRESH_SECONDS = int(os.getenv("EXPORT_CACHE_FRESH_SECONDS", "300"))
+EXPORT_CACHE_TTL = int(os.getenv("EXPORT_CACHE_TTL", str(24 * 3600)))
+# ESP user names, per tenant
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", str(24 * 3600)))
+
+
+def esp_url(tenant: str) -> str:
+    return ESP_URL.format(tenant=tenant)
+
 
 def chatbot_auth(tenant: str, CREDS: str) -> str:
     username = CREDS.split("||")[0]
     password = CREDS.split("||")[1]
-    url = f"https://{tenant}.esp.com/api/authentication/auth/login/"
+    url = f"{esp_url(tenant)}/api/authentication/auth/login/"
     payload = {
         "username": username,
         "password": password
     }
-    response = requests.post(url, json=payload)
+    response = timed_request("auth", tenant, "POST", url, json=payload)
     print("Post to authenticate...")
     if response.status_code == 200:
-        global token
         data = response.json()
         token = data["key"]
         print("Succes. Got token")
@@ -40,203 +139,483 @@ def chatbot_auth(tenant: str, CREDS: str) -> str:
         return "FAILED TO GET TOKEN"
 
 
-def get_graphql(tenant: str, CREDS: str, filter: dict) -> dict:
-    token = chatbot_auth(tenant, CREDS)
-    url = f"https://{tenant}.esp.com/api/graph/"
+class TokenManager():
+    def __init__(self, ttl: int, refresh_margin: int):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.tokens: dict[str, tuple[str, float]] = {}
+        self.tenant_locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def _is_fresh(self, tenant: str) -> bool:
+        cached = self.tokens.get(tenant)
+        return cached is not None and time() < cached[1] - self.refresh_margin
+
+    def _tenant_lock(self, tenant: str) -> threading.Lock:
+        with self.lock:
+            return self.tenant_locks.setdefault(tenant, threading.Lock())
+
+    def get(self, tenant: str, CREDS: str) -> str:
+        if self._is_fresh(tenant):
+            return self.tokens[tenant][0]
+
+        # Callers waiting on the same tenant share the login done by the first one
+        with self._tenant_lock(tenant):
+            if self._is_fresh(tenant):
+                return self.tokens[tenant][0]
+            token = chatbot_auth(tenant, CREDS)
+            if token == "FAILED TO GET TOKEN":
+                raise Exception(f"Error: failed to authenticate to {tenant}")
+            self.tokens[tenant] = (token, time() + self.ttl)
+            return token
+
+    def invalidate(self, tenant: str, token: str) -> None:
+        with self._tenant_lock(tenant):
+            cached = self.tokens.get(tenant)
+            if cached is not None and cached[0] == token:
+                del self.tokens[tenant]
+
+
+tokens = TokenManager(TOKEN_TTL, TOKEN_REFRESH_MARGIN)
+transcript_cache = TranscriptCache(
+    CACHE_DIR, TRANSCRIPT_CACHE_MAX_BYTES, TRANSCRIPT_CACHE_SETTLE_SECONDS)
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+export_cache = ExportCache(CACHE_DIR)
+export_locks: dict[tuple[str, str], threading.Lock] = {}
+export_locks_lock = threading.Lock()
+esp_in_flight = threading.BoundedSemaphore(ESP_MAX_IN_FLIGHT)
+
+
+def timed_request(call: str, tenant: str, method: str, url: str, **kwargs) -> requests.Response:
+    # Every ESP call takes a slot of the shared budget, so tenants running together can't overload ESP
+    with esp_in_flight:
+        start = perf_counter()
+        try:
+            response = client.request(method, url, **kwargs)
+        except Exception:
+            esp_errors_total.inc(call, tenant, "exception")
+            raise
+        finally:
+            esp_request_seconds.observe(perf_counter() - start, call, tenant)
+    if response.status_code >= 400:
+        esp_errors_total.inc(call, tenant, str(response.status_code))
+    return response
+
+
+def esp_request(method: str, tenant: str, CREDS: str, url: str, call: str = "other", **kwargs) -> requests.Response:
+    token = tokens.get(tenant, CREDS)
+    headers = {**kwargs.pop("headers", {}), "Authorization": f"Token {token}"}
+    response = timed_request(call, tenant, method, url,
+                             headers=headers, **kwargs)
+    if response.status_code == 401:
+        print(f"Got 401 from {tenant}, refreshing token")
+        tokens.invalidate(tenant, token)
+        headers["Authorization"] = f"Token {tokens.get(tenant, CREDS)}"
+        response = timed_request(
+            call, tenant, method, url, headers=headers, **kwargs)
+    return response
+
+
+def graphql_fields(columns: Iterable[str]) -> tuple[str, ...]:
+    # Interaction fields to select for a set of report columns. The watermark, the dedup in
+    # process_graphql and transcripts always need theirs, whether or not they are reported
+    return tuple(field for field in INTERACTION_FIELDS if field in columns or field in PIPELINE_FIELDS)
+
+
+def graphql_query(fields: Iterable[str], channel_counts: bool) -> str:
+    selection = "\n            ".join("creation { date }" if field == "creation" else field
+                                      for field in fields)
+    counts = "channelCounts { name count }" if channel_counts else ""
+    return f"""query getInteractions($interactionFilter: InteractionFilter!, $first: Int, $after: String){{
+    interactions(filters: $interactionFilter, first: $first, after: $after){{
+        pageInfo {{ hasNextPage hasPreviousPage startCursor endCursor }}
+        {counts}
+        edges {{ node {{
+            {selection}
+        }} }}
+    }}
+}}"""
+
+
+def get_graphql(tenant: str, CREDS: str, filter: dict, fields: tuple[str, ...] = INTERACTION_FIELDS) -> Iterator[dict]:
+    for nodes, _ in get_graphql_pages(tenant, CREDS, filter, fields):
+        yield from nodes
+
+
+def get_graphql_pages(tenant: str, CREDS: str, filter: dict, fields: tuple[str, ...], after: str | None = None) -> Iterator[tuple[list[dict], str]]:
+    # Nodes of every page with the cursor to continue after it, starting after 'after' if given
+    url = f"{esp_url(tenant)}/api/graph/"
     headers = {
-        'Content-Type': 'application/json',
-        "Authorization": f"Token {token}"
+        'Content-Type': 'application/json'
     }
-    query = """query getInteractions($interactionFilter: InteractionFilter!){
-    interactions(
-      filters: $interactionFilter
-      ){
-        pageInfo {
-            hasNextPage
-            hasPreviousPage
-            startCursor
-            endCursor
-        }
-        channelCounts{
-            name
-            count
-        }
- 
-        edges{  
-            node{
-                    creation {
-                    date
-                    }
-                    eid
-                    interactionText
-                    cleanInteractionText
-                    noResponse
-                    userName
-                    userJobRole
-                    userDepartment
-                    userLocation
-                    city
-                    state
-                    country
-                    matchedArchetypeIntent
-                    actualMatchedIntent
-                    actualMatchedApplication
-                    actualMatchedApplicationType
-                    intentReviewed
-                    source
-                    caseReference
-                    espServiceDepartment
-                    espCategory
-                    espServiceTeam
-                    serviceDepartment
-                    serviceDepartmentClassification
-                    helpfulFeedback
-                    taskFeedback
-                    supportFeedback
-                    deflected
-                    possiblyAbandoned
-                    channel
-                    os
-                    client
-                    isoCountryCode
-                    conversationChannel
-                    kbResponse
-                    userLanguage
-                    actualMatchedIntentReportingLabel
-                    matchedArchetypeIntentReportingLabel
-                    severity
-                    keywords
-                    automationStatus  
-            }  
+    # Channel counts are only logged, so they are only asked for with the first page
+    queries = [graphql_query(fields, True), graphql_query(fields, False)]
+    print(f"Filter: {filter}")
+    first = after is None
+    page = 1
+    while True:
+        variables = {
+            "interactionFilter": filter,
+            "first": GRAPHQL_PAGE_SIZE,
+            "after": after
         }
-        keywordCounts {
-            name
-            count
+        payload = {
+            'query': queries[not first or page > 1],
+            'variables': variables
         }
-    }
-}"""
-    variables = {
-        "interactionFilter": filter
-    }
-    payload = {
-        'query': query,
-        'variables': variables
-    }
-    print(f"Filter: {filter}")
-    print("Making request to GraphQL API...")
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 200:
-        print("Success. Got data")
-        data = response.json()
-        for i in range(len(data['interactions']['channelCounts'])):
+        print(f"Making request to GraphQL API... (page {page})")
+        response = esp_request("POST", tenant, CREDS, url, "graphql",
+                               headers=headers, json=payload)
+        if response.status_code != 200:
             print(
-                f"{data['interactions']['channelCounts'][i]['name']}: {data['interactions']['channelCounts'][i]['count']}")
-        return {"data": data, "token": token}
-    else:
-        print(
-            f"Error in get_graphql: {response.status_code} - {response.text}")
-        return {"error": f"{response.status_code} - {response.text}"}
-
-
-def process_graphql(data: dict) -> list:
-    non_deflected = []
-    deflected = []
-    others = []
-
-    for i in data["interactions"]["edges"]:
-        if i["node"]["deflected"] == False:
-            non_deflected.append(i["node"])
-        elif i["node"]["deflected"] == True:
-            deflected.append(i["node"])
+                f"Error in get_graphql: {response.status_code} - {response.text}")
+            raise Exception(f"Error: {response.status_code} - {response.text}")
+
+        interactions = response.json()["interactions"]
+        del response
+        if first and page == 1:
+            print("Success. Got data")
+            for i in interactions["channelCounts"]:
+                print(f"{i['name']}: {i['count']}")
+
+        after = interactions["pageInfo"]["endCursor"]
+        yield [i["node"] for i in interactions["edges"]], after
+
+        if not interactions["pageInfo"]["hasNextPage"]:
+            break
+        page += 1
+
+
+def shard_filter(filter: dict) -> list[dict]:
+    # Only plain date ranges are split, ranges with times are queried as they are
+    date_range = filter.get("createdDateRange")
+    if not isinstance(date_range, list) or len(date_range) != 2:
+        return [filter]
+    try:
+        start, end = [date.fromisoformat(value) for value in date_range]
+    except (TypeError, ValueError):
+        return [filter]
+
+    step = timedelta(days=GRAPHQL_SHARD_DAYS)
+    if end - start <= step:
+        return [filter]
+    shards = []
+    while start < end:
+        shard_end = min(start + step, end)
+        shards.append({**filter, "createdDateRange": [
+                      f"{start}", f"{shard_end}"]})
+        start = shard_end
+    return shards
+
+
+class Shard():
+    # One date range of a sharded query. Its pages are handed from the thread fetching them to the
+    # generator yielding them as they arrive, the fetch pauses while GRAPHQL_SHARD_BUFFER_PAGES wait
+    def __init__(self, filter: dict):
+        self.filter = filter
+        self.pages: Queue = Queue(maxsize=GRAPHQL_SHARD_BUFFER_PAGES)
+        self.stopped = threading.Event()
+
+    def fetch(self, tenant: str, CREDS: str, fields: tuple[str, ...]) -> None:
+        # A failed shard continues after the last page it handed over instead of starting again
+        after = None
+        for attempt in range(GRAPHQL_SHARD_RETRIES + 1):
+            try:
+                for nodes, cursor in get_graphql_pages(tenant, CREDS, self.filter, fields, after):
+                    if not self.hand_over(nodes):
+                        return
+                    after = cursor
+                self.hand_over(None)
+                return
+            except Exception as e:
+                if attempt == GRAPHQL_SHARD_RETRIES:
+                    self.hand_over(e)
+                    return
+                print(
+                    f"Shard {self.filter['createdDateRange']} failed, retrying from {'the start' if after is None else 'its last page'}: {e}")
+                sleep(2 ** attempt)
+
+    def hand_over(self, item: list[dict] | Exception | None) -> bool:
+        # Gives up once the generator stopped, so the thread doesn't wait for a reader that's gone
+        while not self.stopped.is_set():
+            try:
+                self.pages.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def nodes(self) -> Iterator[dict]:
+        while True:
+            item = self.pages.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+
+def get_graphql_sharded(tenant: str, CREDS: str, filter: dict, fields: tuple[str, ...] = INTERACTION_FIELDS) -> Iterator[dict]:
+    shards = [Shard(shard) for shard in shard_filter(filter)]
+    if len(shards) == 1:
+        yield from get_graphql(tenant, CREDS, filter, fields)
+        return
+
+    print(f"Querying {filter['createdDateRange']} in {len(shards)} shards")
+    # Shards are fetched concurrently but yielded in date order, so process_graphql still keeps the
+    # earliest interaction of every conversation. Shards that share a boundary day can both return
+    # an interaction, it's only yielded once
+    seen = set()
+    with ThreadPoolExecutor(max_workers=GRAPHQL_SHARD_MAX_IN_FLIGHT) as executor:
+        pending = deque()
+        try:
+            for shard in shards:
+                executor.submit(shard.fetch, tenant, CREDS, fields)
+                pending.append(shard)
+                if len(pending) >= GRAPHQL_SHARD_MAX_IN_FLIGHT:
+                    yield from unseen(pending.popleft().nodes(), seen)
+            while pending:
+                yield from unseen(pending.popleft().nodes(), seen)
+        finally:
+            for shard in shards:
+                shard.stopped.set()
+
+
+def unseen(nodes: Iterable[dict], seen: set) -> Iterator[dict]:
+    for node in nodes:
+        if node["eid"] not in seen:
+            seen.add(node["eid"])
+            yield node
+
+
+def process_graphql(nodes: Iterable[dict], exported: set | None = None) -> Iterator[dict]:
+    all_count = 0
+    non_deflected = 0
+    deflected = 0
+    others = 0
+    already_exported = 0
+
+    # Only the first non-deflected interaction of every conversation is kept, conversations
+    # in exported were extracted by earlier incremental runs and are skipped altogether
+    seen_conversations = set()
+    for i in nodes:
+        all_count += 1
+        if i["deflected"] == False:
+            non_deflected += 1
+            if i["conversationChannel"] not in seen_conversations:
+                seen_conversations.add(i["conversationChannel"])
+                if exported and i["conversationChannel"] in exported:
+                    already_exported += 1
+                else:
+                    yield i
+        elif i["deflected"] == True:
+            deflected += 1
         else:
-            others.append(i["node"])
-
-    seen_conversations = {}
-    for i in non_deflected:
-        seen_conversations.setdefault(i["conversationChannel"], i)
-    unique_conversations = list(seen_conversations.values())
+            others += 1
 
-    print(f"All interactions length: {len(data['interactions']['edges'])}")
-    print(f"Non-deflected interactions length: {len(non_deflected)}")
-    print(f"Deflected interactions length: {len(deflected)}")
-    print(f"Other interactions length: {len(others)}")
+    print(f"All interactions length: {all_count}")
+    print(f"Non-deflected interactions length: {non_deflected}")
+    print(f"Deflected interactions length: {deflected}")
+    print(f"Other interactions length: {others}")
     print(
-        f"Unique non-deflected conversations length: {len(unique_conversations)}")
-    print(f"Processing {len(unique_conversations)} items...")
-
-    return unique_conversations
+        f"Unique non-deflected conversations length: {len(seen_conversations)}")
+    if exported:
+        print(f"Conversations exported by earlier runs: {already_exported}")
+
+
+class Watermark():
+    # Tracks the newest interaction creation date seen by an incremental PBI run
+    def __init__(self, creation: str | None = None, eid: str | None = None):
+        self.start = creation
+        self.start_eid = eid
+        self.creation = creation
+        self.eid = eid
+        # Conversations extracted by this run, saved with its partition
+        self.conversations: list[str] = []
+
+    def newer(self, nodes: Iterable[dict]) -> Iterator[dict]:
+        start = datetime.fromisoformat(self.start) if self.start else None
+        newest = datetime.fromisoformat(
+            self.creation) if self.creation else None
+        for i in nodes:
+            created = datetime.fromisoformat(i["creation"]["date"])
+            # Only the interaction the watermark was taken from is skipped at its creation date,
+            # others created at the same time are kept unless their conversation was already exported
+            if start is not None and (created < start or (created == start and i["eid"] == self.start_eid)):
+                continue
+            if newest is None or created > newest:
+                newest = created
+                self.creation = i["creation"]["date"]
+                self.eid = i["eid"]
+            yield i
+
+    def record(self, conversations: Iterable[dict]) -> Iterator[dict]:
+        for i in conversations:
+            self.conversations.append(i["conversationChannel"])
+            yield i
 
 
 class Conv():
-    def __init__(self, count: int, conversation: dict, job_id: str, tenant: str, token: str):
-        for key, value in conversation.items():
-            self.__setattr__(key, value)
-
-        conv_id = self.__getattribute__("conversationChannel")
-        url = f"https://{tenant}.esp.com/api/chat/v0.1/admin_channels/{
-            conv_id}/messages/?format=json&limit=200"
-        headers = {"Authorization": f"Token {token}"}
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            self.__setattr__("events", [i for i in reversed(data["results"])])
+    # One row of a reporting job: the interaction columns, in INTERACTION_FIELDS order, and its transcript.
+    # Rows of a projected report share the tuple of their fields, transcript is None when it isn't reported
+    __slots__ = ("fields", "values", "transcript", "failed")
+
+    def __init__(self, count: int, conversation: dict, job_id: str, tenant: str, CREDS: str,
+                 fields: tuple[str, ...] = INTERACTION_FIELDS, with_transcript: bool = True):
+        self.fields = fields
+        self.values = tuple(conversation.get(field) for field in fields)
+        self.transcript = "" if with_transcript else None
+        self.failed = False
+        if not with_transcript:
+            return
+
+        conv_id = conversation["conversationChannel"]
+        try:
+            data = fetch_messages(tenant, CREDS, conv_id, 200)
             print(f"[{job_id}] {count}. Getting conversation {conv_id}")
-            self.get_transcript(tenant)
-        else:
-            print(
-                f"Error in Conv__init__: {response.status_code} - {response.text}")
-
-    def get_transcript(self, tenant: str):
-        live_agent_id = live_agents[tenant]
-        string = ""
-        for i in self.__getattribute__("events"):
-            if i["type"] == "message":
-                if i["user_id"] == 1:
-                    sender = "chatbot"
-                elif i["user_id"] == live_agent_id:
-                    sender = "Live Agent"
-                else:
-                    sender = self.__getattribute__("userName")
-                string += f"{sender}:\n{i['text']}\n\n"
+            self.transcript = build_transcript(
+                reversed(data["results"]), live_agents[tenant], conversation["userName"])
+            print("Transcript added")
+        except Exception as e:
+            print(f"Error in Conv__init__: {e}")
+            self.failed = True
+
+    def to_dict(self) -> dict:
+        row = dict(zip(self.fields, self.values))
+        if self.transcript is not None:
+            row["transcript"] = self.transcript
+        return row
+
+
+def fetch_messages(tenant: str, CREDS: str, conversation_id: str, limit: int) -> dict:
+    url = f"{esp_url(tenant)}/api/chat/v0.1/admin_channels/{
+        conversation_id}/messages/?format=json"
+
+    cached = transcript_cache.get(tenant, conversation_id)
+    if cached is not None:
+        if transcript_cache.is_settled(cached):
+            transcript_cache.hit()
+            transcript_cache.touch(tenant, conversation_id)
+            return cached["data"]
+        # Still recent, only reuse it if no message was added since it was cached
+        response = esp_request("GET", tenant, CREDS, f"{url}&limit=1", "messages")
+        if response.status_code == 200:
+            results = response.json()["results"]
+            if results and str(results[0].get("id")) == cached["last_message_id"]:
+                transcript_cache.hit()
+                transcript_cache.touch(tenant, conversation_id)
+                return cached["data"]
+
+    transcript_cache.miss()
+    response = esp_request("GET", tenant, CREDS, f"{url}&limit={limit}", "messages")
+    if response.status_code != 200:
+        raise Exception(f"Error: {response.status_code} - {response.text}")
+    data = response.json()
+    # Only complete conversations are cached, newest message first as ESP returns them
+    if data["count"] > 0 and len(data["results"]) >= data["count"]:
+        transcript_cache.put(tenant, conversation_id, data)
+    return data
 
-        self.__setattr__("transcript", string)
-        print("Transcript added")
-        self.__delattr__("events")
 
-    def to_dict(self):
-        return self.__dict__
+def fetch_conversations(conversations: Iterable[dict], job_id: str, tenant: str, CREDS: str,
+                        columns: tuple[str, ...] = REPORT_COLUMNS) -> Iterator[Conv]:
+    fields = tuple(column for column in columns if column != "transcript")
+    if "transcript" not in columns:
+        # Nothing to fetch per conversation, rows are built straight from the interactions
+        print(f"[{job_id}] Transcripts not requested, skipping messages")
+        for index, item in enumerate(conversations):
+            yield Conv(index + 1, item, job_id, tenant, CREDS, fields, False)
+        return
+
+    limit = max_in_flight.get(tenant, DEFAULT_MAX_IN_FLIGHT)
+    print(f"[{job_id}] Fetching conversations, max in flight: {limit}")
+    with ThreadPoolExecutor(max_workers=limit) as executor:
+        # Results are yielded in submission order, so rows keep the order of process_graphql
+        pending = deque()
+        for index, item in enumerate(conversations):
+            pending.append(executor.submit(
+                Conv, index + 1, item, job_id, tenant, CREDS, fields))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    print(
+        f"[{job_id}] Transcript cache hits: {transcript_cache.hits}, misses: {transcript_cache.misses}")
 
 
 def get_messages(tenant: str, CREDS: str, conversation_id: str) -> str:
-    url = f"https://{tenant}.esp.com/api/chat/v0.1/admin_channels/{
-        conversation_id}/messages/?format=json&limit=300"
-    token = chatbot_auth(tenant, CREDS)
-    headers = {
-        "Authorization": f"Token {token}"
-    }
+    return get_transcript(tenant, CREDS, get_conversation(tenant, CREDS, conversation_id))
+
+
+def get_conversation(tenant: str, CREDS: str, conversation_id: str) -> dict:
     print("Getting messages...")
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        print(f"Got conversation {conversation_id}")
-        data = response.json()
-        if data["count"] == 0:
-            raise IndexError(f"No results for {conversation_id}")
-        else:
-            return get_transcript(tenant, data)
-    else:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+    data = fetch_messages(tenant, CREDS, conversation_id, 300)
+    print(f"Got conversation {conversation_id}")
+    if data["count"] == 0:
+        raise IndexError(f"No results for {conversation_id}")
+    return data
 
 
-def get_transcript(tenant: str, data: dict) -> str:
+def fetch_transcripts(tenant: str, CREDS: str, conversation_ids: Iterable[str]) -> Iterator[tuple[str, str | None, str | None]]:
+    # (conversation id, transcript, error), TRANSCRIPT_BATCH_SIZE conversations at a time. Messages of a batch are
+    # fetched at most max_in_flight at a time, then the users of the whole batch are resolved together
+    limit = max_in_flight.get(tenant, DEFAULT_MAX_IN_FLIGHT)
+    ids = iter(conversation_ids)
+    with ThreadPoolExecutor(max_workers=limit) as executor:
+        while batch := list(islice(ids, TRANSCRIPT_BATCH_SIZE)):
+            pending = {executor.submit(get_conversation, tenant, CREDS, conversation_id): conversation_id
+                       for conversation_id in batch}
+            fetched = []
+            try:
+                for future in as_completed(pending):
+                    conversation_id = pending[future]
+                    try:
+                        fetched.append((conversation_id, future.result()))
+                    except IndexError:
+                        yield conversation_id, None, "Conversation not found"
+                    except Exception as e:
+                        yield conversation_id, None, str(e)
+            finally:
+                for future in pending:
+                    future.cancel()
+            yield from get_transcripts(tenant, CREDS, fetched)
+
+
+def get_transcript(tenant: str, CREDS: str, data: dict) -> str:
     live_agent_id = live_agents[tenant]
-    transcript = ""
+    user_id = transcript_user_id(data, live_agent_id)
+    user = get_user_from_id(
+        tenant, CREDS, user_id) if user_id is not None else None
+    return build_transcript(reversed(data["results"]), live_agent_id, user)
+
+
+def get_transcripts(tenant: str, CREDS: str, conversations: list[tuple[str, dict]]) -> Iterator[tuple[str, str | None, str | None]]:
+    # Users of all conversations are resolved together before any transcript is built
+    live_agent_id = live_agents[tenant]
+    user_ids = [transcript_user_id(data, live_agent_id)
+                for _, data in conversations]
+    users = resolve_users(tenant, CREDS, [
+                          user_id for user_id in user_ids if user_id is not None])
+    for (conversation_id, data), user_id in zip(conversations, user_ids):
+        if user_id is not None and user_id not in users:
+            yield conversation_id, None, f"User {user_id} could not be resolved"
+        else:
+            yield conversation_id, build_transcript(reversed(data["results"]), live_agent_id, users.get(user_id)), None
+
+
+def transcript_user_id(data: dict, live_agent_id: int) -> int | None:
+    # The first message sent by someone other than the chatbot or the live agent
     for i in reversed(data["results"]):
         if i["type"] == "message":
             if i["user_id"] != 1 and i["user_id"] != live_agent_id:
-                user = get_user_from_id(tenant, token, i["user_id"])
-                break
+                return i["user_id"]
+    return None
 
-    for i in reversed(data["results"]):
+
+def build_transcript(events: Iterable[dict], live_agent_id: int, user: str | None) -> str:
+    # Built in one pass and joined once, long live agent chats would be quadratic with +=
+    parts = []
+    for i in events:
         if i["type"] == "message":
             if i["user_id"] == 1:
                 sender = "chatbot"
@@ -244,115 +623,223 @@ def get_transcript(tenant: str, data: dict) -> str:
                 sender = "Live Agent"
             else:
                 sender = user
-            transcript += f"{sender}:\n{i['text']}\n\n"
+            parts.append(f"{sender}:\n{i['text']}\n\n")
+    return "".join(parts)
 
-    return transcript
 
+def get_user_from_id(tenant: str, CREDS: str, user_id: int) -> str:
+    name = user_cache.get(tenant, user_id)
+    if name is not None:
+        return name
+    return fetch_user(tenant, CREDS, user_id)
 
-def get_user_from_id(tenant: str, token: str, user_id: int) -> str:
+
+def fetch_user(tenant: str, CREDS: str, user_id: int) -> str:
     print("Getting user...")
-    url = f"https://{tenant}.esp.com/api/espuser/v0.1/users/{user_id}/"
-    headers = {
-        "Authorization": f"Token {token}"
-    }
-    response = requests.get(url, headers=headers)
+    url = f"{esp_url(tenant)}/api/espuser/v0.1/users/{user_id}/"
+    response = esp_request("GET", tenant, CREDS, url, "user")
     if response.status_code == 200:
         data = response.json()
+        user_cache.put(tenant, user_id, data["full_name"])
         return data["full_name"]
     else:
         raise Exception(f"Error: {response.status_code} - {response.text}")
 
 
-def get_exporting_data(tenant: str, CREDS: str, resource: str) -> list:
-
+def resolve_users(tenant: str, CREDS: str, user_ids: Iterable[int]) -> dict[int, str]:
+    # Names of many users at once, the ones not cached yet are fetched concurrently
+    names = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        name = user_cache.get(tenant, user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+    if missing:
+        limit = max_in_flight.get(tenant, DEFAULT_MAX_IN_FLIGHT)
+        with ThreadPoolExecutor(max_workers=min(limit, len(missing))) as executor:
+            pending = {executor.submit(fetch_user, tenant, CREDS, user_id): user_id
+                       for user_id in missing}
+            # Users that can't be fetched are left out, only their conversations fail
+            for future in as_completed(pending):
+                try:
+                    names[pending[future]] = future.result()
+                except Exception as e:
+                    print(f"Error getting user {pending[future]}: {e}")
+    return names
+
+
+class PaginationError(Exception):
+    def __init__(self, url: str, failed: list[tuple[int, str]]):
+        self.url = url
+        self.failed = failed
+        super().__init__(
+            f"Error: {len(failed)} page(s) of {url} failed: {failed}")
+
+
+def export_url(tenant: str, resource: str) -> str:
     match resource:
         case "configuration":
-            url = f"https://{tenant}.esp.com/api/config/v0.1/configuration/?limit=200&format=json"
+            url = f"{esp_url(tenant)}/api/config/v0.1/configuration/?limit=200&format=json"
         case "variables":
-            url = f"https://{tenant}.esp.com/api/chatbot/v0.1/variables/?limit=200&format=json"
+            url = f"{esp_url(tenant)}/api/chatbot/v0.1/variables/?limit=200&format=json"
         case "localization":
-            url = f"https://{tenant}.esp.com/api/common/v0.1/localization?limit=200&format=json"
+            url = f"{esp_url(tenant)}/api/common/v0.1/localization?limit=200&format=json"
         case "kb_support":
-            url = f"https://{tenant}.esp.com/api/chatbot/v0.1/kb_support/?limit=200&format=json"
+            url = f"{esp_url(tenant)}/api/chatbot/v0.1/kb_support/?limit=200&format=json"
+    return url
+
+
+def export_fingerprint(first_page: dict) -> str:
+    # Item count plus a hash of the first page, which changes when items are added, removed or edited there
+    results = json.dumps(first_page["results"], sort_keys=True, default=str)
+    return f"{first_page['count']}:{hashlib.sha256(results.encode()).hexdigest()}"
+
+
+def get_cached_export(tenant: str, CREDS: str, resource: str) -> tuple[dict, str]:
+    # Cached rows of a resource and how they were served: "hit", "revalidated" or "miss"
+    with export_locks_lock:
+        lock = export_locks.setdefault((tenant, resource), threading.Lock())
+    # Requests for the same export wait for the one already fetching it
+    with lock:
+        entry = export_cache.get(tenant, resource)
+        now = time()
+        if entry is not None and now - entry["fetched"] < EXPORT_CACHE_TTL:
+            if now - entry["validated"] < EXPORT_CACHE_FRESH_SECONDS:
+                return entry, "hit"
+            first_page = get_page(tenant, CREDS, export_url(tenant, resource))
+            if export_fingerprint(first_page) == entry["fingerprint"]:
+                export_cache.validated(tenant, resource)
+                return entry, "revalidated"
+            print(f"{resource} of {tenant} changed, fetching it again")
+        else:
+            first_page = get_page(tenant, CREDS, export_url(tenant, resource))
+
+        entry = export_cache.put(tenant, resource, export_fingerprint(
+            first_page), make_requests(tenant, CREDS, export_url(tenant, resource), first_page))
+        return entry, "miss"
+
+
+def get_page(tenant: str, CREDS: str, url: str) -> dict:
+    print("Making request...")
+    r = esp_request("GET", tenant, CREDS, url, "export_page")
+    if r.status_code != 200:
+        print(f"Error in make_requests: {r.status_code} - {r.text}")
+        raise Exception(f"Error: {r.status_code} - {r.text}")
+    print("Got data")
+    return r.json()
+
+
+def page_url(url: str, offset: int) -> str:
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    query["offset"] = [str(offset)]
+    return parsed._replace(query=urlencode(query, doseq=True)).geturl()
+
+
+def make_requests(tenant: str, CREDS: str, url: str, first_page: dict | None = None) -> Iterator[dict]:
+    json_data = first_page if first_page is not None else get_page(
+        tenant, CREDS, url)
+    count = json_data["count"]
+    print(f"Items count: {count}")
+    yield from json_data["results"]
+
+    next_url = json_data["next"]
+    if next_url is None:
+        return
+
+    next_query = parse_qs(urlparse(next_url).query)
+    if "limit" not in next_query or "offset" not in next_query:
+        # Not limit/offset paginated, so pages can only be followed one by one
+        while next_url is not None:
+            json_data = get_page(tenant, CREDS, next_url)
+            yield from json_data["results"]
+            next_url = json_data["next"]
+        return
+
+    # The remaining offsets are known from count, so pages are fetched concurrently and yielded in order
+    limit = int(next_query["limit"][0])
+    offsets = range(len(json_data["results"]), count, limit)
+    failed = []
+    with ThreadPoolExecutor(max_workers=PAGINATION_MAX_IN_FLIGHT) as executor:
+        pending = deque()
+        for offset in offsets:
+            pending.append((offset, executor.submit(
+                get_page, tenant, CREDS, page_url(next_url, offset))))
+            if len(pending) >= PAGINATION_MAX_IN_FLIGHT:
+                yield from page_results(pending.popleft(), failed)
+        while pending:
+            yield from page_results(pending.popleft(), failed)
+
+    if failed:
+        raise PaginationError(url, failed)
+
+
+def page_results(page: tuple, failed: list[tuple[int, str]]) -> list[dict]:
+    offset, future = page
+    try:
+        return future.result()["results"]
+    except Exception as e:
+        failed.append((offset, str(e)))
+        return []
+
+
+def get_export_status(tenant: str, CREDS: str, url: str) -> dict:
+    response = esp_request("GET", tenant, CREDS, url, "survey")
+    if response.status_code != 200:
+        raise Exception(f"Error: {response.status_code} - {response.text}")
+    return response.json()
 
-    token = chatbot_auth(tenant, CREDS)
-    headers = {
-        "Authorization": f"Token {token}"
-    }
-    data = make_requests(url, headers, True, [])
-    return data
 
+def export_file_ready(data: dict) -> bool:
+    return bool((data.get("sys_custom_fields") or {}).get("file"))
 
-def make_requests(url: str, headers: dict, initial_request: bool, full_data: list) -> list:
-    if not initial_request:
-        sleep(1)
-
-    if url != None:
-        print("Making request...")
-        r = requests.get(url, headers=headers)
-        if r.status_code == 200:
-            print("Got data")
-            json_data = r.json()
-            if initial_request:
-                print(f"Items count: {json_data['count']}")
-            for i in json_data["results"]:
-                full_data.append(i)
-            if json_data["next"] == None:
-                return full_data
-            else:
-                return make_requests(json_data["next"], headers, False, full_data)
-        else:
-            print(f"Error in make_requests: {r.status_code} - {r.text}")
-            return ["ERROR"]
-    else:
-        return full_data
+
+async def wait_for_export(tenant: str, CREDS: str, status_url: str, is_ready: Callable[[dict], bool] = export_file_ready, deadline: float = EXPORT_POLL_DEADLINE) -> dict:
+    failed_statuses = ["failed", "error", "cancelled", "canceled"]
+    delay = EXPORT_POLL_INITIAL
+    end = monotonic() + deadline
+    while True:
+        # Each poll is a short blocking request, the waiting in between happens on the event loop
+        data = await asyncio.to_thread(get_export_status, tenant, CREDS, status_url)
+        status = str(data.get("status", "")).lower()
+        print(f"Export status: {status}")
+        if status in failed_statuses:
+            raise Exception(f"Error: export {status_url} {status}")
+        if is_ready(data):
+            return data
+
+        if monotonic() + delay > end:
+            raise TimeoutError(
+                f"Export {status_url} not ready after {deadline} seconds")
+        # Full jitter, so exports started at the same time don't poll in lockstep
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, EXPORT_POLL_MAX)
 
 
-def get_surveys(CREDS: str, today, yesterday) -> bytes | str:
-    token = chatbot_auth("tenant", CREDS)
-    url = f"https://tenant.esp.com/api/chatbot/v0.1/report9_data/csv/?end_date={
+async def get_surveys(CREDS: str, today, yesterday) -> bytes | str:
+    url = f"{esp_url('tenant')}/api/chatbot/v0.1/report9_data/csv/?end_date={
         yesterday}&esp_filters=live_chat_interaction_feedback__!ISNULL%3DTrue&header=conversation_channel%2Csys_date_created%2Cinteraction_text%2Ccase_reference%2Cuser_name%2Cactual_matched_intent%2Cesp_service_department%2Csource%2Cno_response%2Cdeflected%2Ckb_response%2Chelpful_feedback%2Cpossibly_abandoned%2Clive_chat_interaction_feedback&start_date={yesterday}&format=json"
-    headers = {
-        "Authorization": f"Token {token}"
-    }
-    response = requests.get(url, headers=headers)
+    response = await asyncio.to_thread(esp_request, "GET", "tenant", CREDS, url, "survey")
     if response.status_code == 200:
         print("Success. Job started")
         data = response.json()
         print(data["status"])
         status_url = data["url"] + "&format=json"
         print(status_url)
-        print("Waiting 30 seconds")
-        sleep(30)
-        download_url = get_download_url(token, status_url)
-        survey_data = download_data(token, download_url)
-        return survey_data
-    else:
-        print(f"{response.status_code} - {response.text}")
-        return f"{response.status_code} - {response.text}"
-
-
-def get_download_url(token: str, url: str) -> str:
-    headers = {
-        "Authorization": f"Token {token}"
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
+        data = await wait_for_export("tenant", CREDS, status_url)
         print("Success. Got download url")
-        data = response.json()
-        print(data["status"])
         download_url = data["sys_custom_fields"]["file"]
-        return download_url
+        survey_data = await asyncio.to_thread(download_data, "tenant", CREDS, download_url)
+        return survey_data
     else:
         print(f"{response.status_code} - {response.text}")
         return f"{response.status_code} - {response.text}"
 
 
-def download_data(token: str, url: str) -> bytes | str:
-    headers = {
-        "Authorization": f"Token {token}"
-    }
-    response = requests.get(url, headers=headers)
+def download_data(tenant: str, CREDS: str, url: str) -> bytes | str:
+    response = esp_request("GET", tenant, CREDS, url, "survey")
     if response.status_code == 200:
         print("Success. Got data")
         print(f"Type of data: {type(response.content)}")
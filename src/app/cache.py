@@ -0,0 +1,253 @@
+import os
+import gzip
+import json
+import hashlib
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from time import time, monotonic
+
+# The transcript cache keeps a running total of its size, recounted from SQLite every
+# TRANSCRIPT_RECOUNT_PUTS puts to pick up what other workers stored or evicted
+TRANSCRIPT_RECOUNT_PUTS = 1000
+
+
+class TranscriptCache():
+    # Conversation messages keyed by tenant + conversationChannel, stored compressed in SQLite
+    # and evicted least recently used first once the cache grows over max_bytes
+    def __init__(self, directory: str, max_bytes: int, settle_seconds: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle_seconds = settle_seconds
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.evicting = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.total = None
+        self.puts = 0
+        os.makedirs(directory, exist_ok=True)
+        with self.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS transcripts (
+                tenant TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                last_message_id TEXT,
+                last_message_date TEXT,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (tenant, conversation)
+            )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts (accessed)")
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(
+                self.directory, "transcripts.sqlite3"), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, tenant: str, conversation: str) -> dict | None:
+        row = self.connection().execute("SELECT last_message_id, last_message_date, data FROM transcripts WHERE tenant = ? AND conversation = ?",
+                                        (tenant, conversation)).fetchone()
+        if row is None:
+            return None
+        return {
+            "last_message_id": row["last_message_id"],
+            "last_message_date": row["last_message_date"],
+            "data": json.loads(zlib.decompress(row["data"]))
+        }
+
+    def put(self, tenant: str, conversation: str, data: dict) -> None:
+        last_message = data["results"][0]
+        blob = zlib.compress(json.dumps(data).encode())
+        with self.connection() as conn:
+            old = conn.execute("SELECT size FROM transcripts WHERE tenant = ? AND conversation = ?",
+                               (tenant, conversation)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (tenant, conversation, str(last_message.get("id")), last_message.get("sys_date_created"), len(blob), time(), blob))
+        with self.lock:
+            self.puts += 1
+            recount = self.total is None or self.puts % TRANSCRIPT_RECOUNT_PUTS == 0
+            if not recount:
+                self.total += len(blob) - (old["size"] if old else 0)
+        if recount:
+            total = self.connection().execute(
+                "SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+            with self.lock:
+                self.total = total
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def hit(self) -> None:
+        with self.lock:
+            self.hits += 1
+
+    def miss(self) -> None:
+        with self.lock:
+            self.misses += 1
+
+    def touch(self, tenant: str, conversation: str) -> None:
+        with self.connection() as conn:
+            conn.execute("UPDATE transcripts SET accessed = ? WHERE tenant = ? AND conversation = ?",
+                         (time(), tenant, conversation))
+
+    def is_settled(self, entry: dict) -> bool:
+        # A conversation without new messages for settle_seconds is treated as closed
+        if not entry["last_message_date"]:
+            return False
+        try:
+            last_message_date = datetime.fromisoformat(
+                entry["last_message_date"])
+        except ValueError:
+            return False
+        return time() - last_message_date.timestamp() > self.settle_seconds
+
+    def evict(self) -> None:
+        # One thread evicts at a time, the others carry on with their puts
+        if not self.evicting.acquire(blocking=False):
+            return
+        try:
+            conn = self.connection()
+            # Evict down to 90% so the next few puts don't have to evict again
+            target = self.max_bytes * 0.9
+            with conn:
+                while self.total > target:
+                    rows = conn.execute(
+                        "SELECT tenant, conversation, size FROM transcripts ORDER BY accessed LIMIT 100").fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        conn.execute("DELETE FROM transcripts WHERE tenant = ? AND conversation = ?",
+                                     (row["tenant"], row["conversation"]))
+                        with self.lock:
+                            self.total -= row["size"]
+                        if self.total <= target:
+                            break
+        finally:
+            self.evicting.release()
+
+
+class UserCache():
+    # ESP user id -> full name, in memory per tenant, entries expire after ttl seconds
+    # and each tenant keeps at most max_size of them, least recently used dropped first
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tenants: dict[str, OrderedDict] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tenant: str, user_id: int) -> str | None:
+        with self.lock:
+            users = self.tenants.get(tenant)
+            cached = users.get(user_id) if users is not None else None
+            if cached is None or cached[1] < monotonic():
+                if cached is not None:
+                    del users[user_id]
+                self.misses += 1
+                return None
+            users.move_to_end(user_id)
+            self.hits += 1
+            return cached[0]
+
+    def put(self, tenant: str, user_id: int, name: str) -> None:
+        with self.lock:
+            users = self.tenants.setdefault(tenant, OrderedDict())
+            users[user_id] = (name, monotonic() + self.ttl)
+            users.move_to_end(user_id)
+            while len(users) > self.max_size:
+                users.popitem(last=False)
+
+
+class ExportCache():
+    # Rows of configuration exports per tenant + resource, kept as gzipped NDJSON files next to the
+    # files rendered from them. Entries are identified by the hash of their rows, which is also the ETag
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, "exports")
+        self.local = threading.local()
+        os.makedirs(self.directory, exist_ok=True)
+        with self.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS exports (
+                tenant TEXT NOT NULL,
+                resource TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                validated REAL NOT NULL,
+                PRIMARY KEY (tenant, resource)
+            )""")
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(
+                self.directory, "exports.sqlite3"), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, tenant: str, resource: str) -> dict | None:
+        row = self.connection().execute("SELECT * FROM exports WHERE tenant = ? AND resource = ?",
+                                        (tenant, resource)).fetchone()
+        if row is None or not os.path.exists(self.rows_path(row["tenant"], row["resource"], row["etag"])):
+            return None
+        return dict(row)
+
+    def put(self, tenant: str, resource: str, fingerprint: str, rows: Iterable[dict]) -> dict:
+        # Rows are written as they are fetched, the file is named after their hash once it's complete
+        part = os.path.join(self.directory, f"{tenant}_{resource}.part")
+        digest = hashlib.sha256()
+        count = 0
+        try:
+            with gzip.open(part, "wt", encoding="utf-8") as f:
+                for row in rows:
+                    line = json.dumps(row, default=str) + "\n"
+                    digest.update(line.encode())
+                    f.write(line)
+                    count += 1
+        except Exception:
+            os.remove(part)
+            raise
+        etag = digest.hexdigest()[:32]
+        os.replace(part, self.rows_path(tenant, resource, etag))
+
+        now = time()
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (tenant, resource, fingerprint, etag, count, now, now))
+        self.remove_stale(tenant, resource, etag)
+        return self.get(tenant, resource)
+
+    def validated(self, tenant: str, resource: str) -> None:
+        with self.connection() as conn:
+            conn.execute("UPDATE exports SET validated = ? WHERE tenant = ? AND resource = ?",
+                         (time(), tenant, resource))
+
+    def rows(self, entry: dict) -> Iterator[dict]:
+        with gzip.open(self.rows_path(entry["tenant"], entry["resource"], entry["etag"]), "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def rows_path(self, tenant: str, resource: str, etag: str) -> str:
+        return os.path.join(self.directory, f"{tenant}_{resource}_{etag}.ndjson.gz")
+
+    def file_path(self, entry: dict, format: str) -> str:
+        return os.path.join(self.directory, f"{entry['tenant']}_{entry['resource']}_{entry['etag']}.{format}")
+
+    def remove_stale(self, tenant: str, resource: str, etag: str) -> None:
+        # Files of earlier versions, a download still streaming one keeps its open handle
+        prefix = f"{tenant}_{resource}_"
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and not name.startswith(f"{prefix}{etag}."):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,49 @@
+import os
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One keep-alive session per ESP host, shared by every job and request handler
+POOL_SIZE = int(os.getenv("ESP_POOL_SIZE", "10"))
+CONNECT_TIMEOUT = float(os.getenv("ESP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("ESP_READ_TIMEOUT", "120"))
+RETRIES = int(os.getenv("ESP_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("ESP_BACKOFF_FACTOR", "0.5"))
+
+sessions: dict[str, requests.Session] = {}
+sessions_lock = threading.Lock()
+
+
+def new_session() -> requests.Session:
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        status=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None,
+        # Give the last response back to the caller instead of raising
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    host = urlparse(url).netloc
+    with sessions_lock:
+        if host not in sessions:
+            sessions[host] = new_session()
+        return sessions[host]
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session(url).request(method, url, **kwargs)
@@ -0,0 +1,279 @@
+import os
+import csv
+import json
+import re
+import hashlib
+import zlib
+import zipfile
+import tempfile
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from openpyxl import Workbook
+
+# Optional, Parquet results and zstd downloads are only offered when these are installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+export_formats = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson"
+}
+transcript_formats = {
+    "zip": "application/zip",
+    "ndjson": "application/x-ndjson"
+}
+
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+# Buffered rows are written out as one Parquet row group once there are PARQUET_ROW_GROUP_SIZE of them,
+# or once their text adds up to PARQUET_ROW_GROUP_BYTES, transcripts make rows large
+PARQUET_ROW_GROUP_SIZE = 1000
+PARQUET_ROW_GROUP_BYTES = 1024 * 1024
+
+
+def write_xlsx(rows: Iterable[dict], path: str) -> int:
+    # Write-only workbooks stream rows to disk instead of keeping every cell in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    count = 0
+    for row in rows:
+        if count == 0:
+            ws.append(list(row.keys()))
+        ws.append([str(value) for value in row.values()])
+        count += 1
+    wb.save(path)
+    return count
+
+
+def write_csv(rows: Iterable[dict], path: str) -> int:
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        for row in rows:
+            if count == 0:
+                writer.writerow(row.keys())
+            writer.writerow([str(value) for value in row.values()])
+            count += 1
+    return count
+
+
+def write_ndjson(rows: Iterable[dict], path: str) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def export_to_file(rows: Iterable[dict], format: str, directory: str | None = None) -> str:
+    fd, path = tempfile.mkstemp(
+        prefix="export_", suffix=f".{format}", dir=directory)
+    os.close(fd)
+    try:
+        match format:
+            case "xlsx":
+                count = write_xlsx(rows, path)
+            case "csv":
+                count = write_csv(rows, path)
+            case "ndjson":
+                count = write_ndjson(rows, path)
+    except Exception:
+        os.remove(path)
+        raise
+    print(f"Exported {count} rows to {path}")
+    return path
+
+
+def parquet_available() -> bool:
+    return pyarrow is not None
+
+
+def parquet_type(column: str):
+    # Reporting columns with a known type, everything else is kept as text
+    match column:
+        case "creation":
+            return pyarrow.timestamp("us", tz="UTC")
+        case "noResponse" | "intentReviewed" | "deflected" | "possiblyAbandoned":
+            return pyarrow.bool_()
+        case "keywords":
+            return pyarrow.list_(pyarrow.string())
+        case _:
+            return pyarrow.string()
+
+
+def parquet_value(column: str, value):
+    if value is None:
+        return None
+    match column:
+        case "creation":
+            return datetime.fromisoformat(value["date"] if isinstance(value, dict) else value)
+        case "noResponse" | "intentReviewed" | "deflected" | "possiblyAbandoned":
+            return bool(value)
+        case "keywords":
+            return [str(keyword) for keyword in value]
+        case _:
+            return str(value)
+
+
+class ParquetWriter():
+    # Writes rows to a typed Parquet file in small row groups, so only one group is held in memory
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+        self.columns: list[str] = []
+        self.buffer: dict[str, list] = {}
+        self.rows = 0
+        self.size = 0
+
+    def write(self, row: dict) -> None:
+        if self.writer is None:
+            self.columns = list(row.keys())
+            schema = pyarrow.schema([(column, parquet_type(column))
+                                    for column in self.columns])
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.path, schema, compression="zstd")
+            self.buffer = {column: [] for column in self.columns}
+        # Values are converted as they come in, so a bad one fails its own row and nothing is half buffered
+        values = [parquet_value(column, row[column]) for column in self.columns]
+        for column, value in zip(self.columns, values):
+            self.buffer[column].append(value)
+        self.rows += 1
+        self.size += sum(len(value)
+                         for value in values if isinstance(value, str))
+        if self.rows >= PARQUET_ROW_GROUP_SIZE or self.size >= PARQUET_ROW_GROUP_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        self.writer.write_table(pyarrow.table(
+            self.buffer, schema=self.writer.schema))
+        self.buffer = {column: [] for column in self.columns}
+        self.rows = 0
+        self.size = 0
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+
+    def abort(self) -> None:
+        # Drops the file written so far
+        try:
+            if self.writer is not None:
+                self.writer.close()
+        except Exception:
+            pass
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def merge_parquet(paths: list[str]) -> str:
+    # Partitions share one schema, so their row groups are copied into a single file one by one
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".parquet")
+    os.close(fd)
+    writer = None
+    try:
+        for source in paths:
+            file = pyarrow.parquet.ParquetFile(source)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(
+                    path, file.schema_arrow, compression="zstd")
+            for index in range(file.num_row_groups):
+                writer.write_table(file.read_row_group(index))
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+
+def content_encodings() -> list[str]:
+    # Supported CSV download encodings, in order of preference
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def compressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    # wbits 31 writes a gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+class StreamBuffer():
+    # Write-only file for zipfile, the bytes written so far are taken out with drain(). Without
+    # seek and tell zipfile writes entries with data descriptors, so the archive can be streamed
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def transcript_filename(conversation_id: str, used: set[str]) -> str:
+    # Ids that only differ in replaced characters or in case, e.g. 'a.b' and 'a_b', get a short hash of the id
+    # added, so no file overwrites another when the archive is extracted
+    safe = re.sub(r'[^A-Za-z0-9_-]', '_', conversation_id)
+    filename = f"{safe}_transcript.txt"
+    if filename.lower() in used:
+        digest = hashlib.sha1(conversation_id.encode()).hexdigest()[:8]
+        filename = f"{safe}_{digest}_transcript.txt"
+        counter = 1
+        while filename.lower() in used:
+            counter += 1
+            filename = f"{safe}_{digest}_{counter}_transcript.txt"
+    used.add(filename.lower())
+    return filename
+
+
+def transcripts_zip(results: Iterable[tuple[str, str | None, str | None]], manifest: dict) -> Iterator[bytes]:
+    # One text file per transcript, and manifest.json with the files and the errors at the end.
+    # 'files' in the manifest maps every conversation id to its file
+    buffer = StreamBuffer()
+    used = set()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for conversation_id, transcript, error in results:
+            if error is None:
+                filename = transcript_filename(conversation_id, used)
+                archive.writestr(filename, transcript)
+                manifest["succeeded"].append(conversation_id)
+                manifest.setdefault("files", {})[conversation_id] = filename
+            else:
+                manifest["errors"][conversation_id] = error
+            yield buffer.drain()
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    yield buffer.drain()
+
+
+def transcripts_ndjson(results: Iterable[tuple[str, str | None, str | None]], manifest: dict) -> Iterator[bytes]:
+    # One line per conversation, then a last line with the manifest
+    for conversation_id, transcript, error in results:
+        if error is None:
+            manifest["succeeded"].append(conversation_id)
+            line = {"conversation_id": conversation_id,
+                    "transcript": transcript}
+        else:
+            manifest["errors"][conversation_id] = error
+            line = {"conversation_id": conversation_id, "error": error}
+        yield (json.dumps(line) + "\n").encode()
+    yield (json.dumps({"manifest": manifest}) + "\n").encode()
@@ -0,0 +1,378 @@
+import os
+import json
+import socket
+import sqlite3
+import threading
+from time import time, sleep
+
+
+class SQLiteJobStore():
+    # Job metadata lives in SQLite and results are plain files next to it,
+    # so every uvicorn worker sees the same jobs and they survive restarts
+    def __init__(self, directory: str, ttl: int, reuse_ttl: int = 0, evict_interval: int = 600,
+                 heartbeat_interval: int = 30, heartbeat_timeout: int = 300):
+        self.directory = directory
+        self.ttl = ttl
+        # Finished jobs started with a job key are handed out again for reuse_ttl seconds
+        self.reuse_ttl = reuse_ttl
+        # Workers refresh 'updated' of their unfinished jobs every heartbeat_interval seconds,
+        # a job nobody refreshed for heartbeat_timeout seconds belongs to a worker that is gone
+        self.heartbeat_timeout = heartbeat_timeout
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.local = threading.local()
+        os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "partitions"), exist_ok=True)
+        with self.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                tenant TEXT,
+                status TEXT NOT NULL,
+                is_scheduled INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                worker TEXT,
+                error TEXT,
+                result TEXT,
+                job_key TEXT,
+                downloaded REAL,
+                progress TEXT
+            )""")
+            # Stores created by older versions are missing the columns added since
+            columns = [row["name"] for row in conn.execute(
+                "PRAGMA table_info(jobs)")]
+            for column, type in [("job_key", "TEXT"), ("downloaded", "REAL"), ("progress", "TEXT")]:
+                if column not in columns:
+                    conn.execute(
+                        f"ALTER TABLE jobs ADD COLUMN {column} {type}")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, created)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_tenant ON jobs (tenant, is_scheduled, created)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+            # Newest interaction creation date already extracted by incremental PBI jobs
+            conn.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+                tenant TEXT PRIMARY KEY,
+                creation TEXT NOT NULL,
+                eid TEXT,
+                updated REAL NOT NULL
+            )""")
+            # Append-only PBI results, one file per incremental run
+            conn.execute("""CREATE TABLE IF NOT EXISTS partitions (
+                job_id TEXT PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                path TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                watermark_from TEXT,
+                watermark_to TEXT NOT NULL,
+                created REAL NOT NULL
+            )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS partitions_tenant ON partitions (tenant, created)")
+            # Conversations in the partitions of a tenant, so later runs don't extract them again
+            conn.execute("""CREATE TABLE IF NOT EXISTS exported_conversations (
+                tenant TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                job_id TEXT NOT NULL,
+                PRIMARY KEY (tenant, conversation)
+            )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS exported_conversations_job ON exported_conversations (job_id)")
+            # PBI jobs started together by one fan-out request
+            conn.execute("""CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT NOT NULL,
+                tenant TEXT NOT NULL,
+                job_id TEXT,
+                created REAL NOT NULL,
+                error TEXT,
+                PRIMARY KEY (batch_id, tenant)
+            )""")
+            # Why a tenant got no job, e.g. a full queue
+            columns = [row["name"] for row in conn.execute(
+                "PRAGMA table_info(batches)")]
+            if "error" not in columns:
+                conn.execute("ALTER TABLE batches ADD COLUMN error TEXT")
+        self.fail_interrupted()
+        self.evict_expired()
+        # Expired jobs are evicted on a timer, so requests never wait for files to be deleted
+        threading.Thread(target=self.evict_periodically,
+                         args=(evict_interval,), daemon=True).start()
+        threading.Thread(target=self.heartbeat_periodically,
+                         args=(heartbeat_interval,), daemon=True).start()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(
+                self.directory, "jobs.sqlite3"), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def create(self, job_id: str, tenant: str | None = None, is_scheduled: bool = False) -> dict:
+        now = time()
+        with self.connection() as conn:
+            conn.execute("INSERT INTO jobs (job_id, tenant, status, is_scheduled, created, updated, worker) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, tenant, "queued", int(is_scheduled), now, now, self.worker))
+        return self.get(job_id)
+
+    def find_or_create(self, job_id: str, tenant: str, job_key: str, is_scheduled: bool = False) -> tuple[dict, bool]:
+        # A job with the same key that is still running, or finished recently, is returned instead of
+        # creating a new one. The write lock is taken first, so two workers can't both create it
+        now = time()
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A job whose worker went away, e.g. in a redeploy, would never finish, so it is failed rather than joined
+            self.fail_stale(conn, job_key)
+            row = conn.execute("""SELECT * FROM jobs WHERE job_key = ? AND (status IN ('queued', 'processing')
+                OR (status = 'completed' AND result IS NOT NULL AND updated > ?)) ORDER BY created DESC LIMIT 1""",
+                               (job_key, now - self.reuse_ttl)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO jobs (job_id, tenant, status, is_scheduled, created, updated, worker, job_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (job_id, tenant, "queued", int(is_scheduled), now, now, self.worker, job_key))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if row is not None:
+            return self.to_dict(row), False
+        return self.get(job_id), True
+
+    def mark_downloaded(self, job_id: str) -> None:
+        # Shared results stay around while they can be reused, anything else goes once it's downloaded
+        job = self.get(job_id)
+        if job is None:
+            return
+        if job["job_key"] is None or self.reuse_ttl <= 0:
+            self.delete(job_id)
+            return
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET downloaded = ? WHERE job_id = ?",
+                         (time(), job_id))
+
+    def get(self, job_id: str) -> dict | None:
+        row = self.connection().execute(
+            "SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self.to_dict(row)
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated"] = time()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self.connection() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                         (*fields.values(), job_id))
+
+    def update_unless_cancelled(self, job_id: str, **fields) -> bool:
+        # Cancelled is final, a job cancelled or deleted in the meantime is left as it is
+        fields["updated"] = time()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self.connection() as conn:
+            cursor = conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ? AND status != 'cancelled'",
+                                  (*fields.values(), job_id))
+        return cursor.rowcount > 0
+
+    def cancel(self, job_id: str) -> bool:
+        # Only a job that hasn't finished yet can be cancelled, one that completed or failed in the meantime is left as it is
+        with self.connection() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE job_id = ? AND status IN ('queued', 'processing')",
+                                  (time(), job_id))
+        return cursor.rowcount > 0
+
+    def delete(self, job_id: str) -> None:
+        job = self.get(job_id)
+        if job is None:
+            return
+        with self.connection() as conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        self.remove_result(job)
+
+    def list_ids(self) -> list[str]:
+        rows = self.connection().execute(
+            "SELECT job_id FROM jobs ORDER BY created").fetchall()
+        return [row["job_id"] for row in rows]
+
+    def latest_for_tenant(self, tenant: str, is_scheduled: bool = True) -> dict | None:
+        row = self.connection().execute("SELECT * FROM jobs WHERE tenant = ? AND is_scheduled = ? ORDER BY created DESC LIMIT 1",
+                                        (tenant, int(is_scheduled))).fetchone()
+        return self.to_dict(row)
+
+    def result_path(self, job_id: str, extension: str = "csv") -> str:
+        return os.path.join(self.directory, "results", f"{job_id}.{extension}")
+
+    def evict_expired(self) -> int:
+        rows = self.connection().execute("SELECT * FROM jobs WHERE created < ? OR (downloaded IS NOT NULL AND updated < ?)",
+                                         (time() - self.ttl, time() - self.reuse_ttl)).fetchall()
+        for row in rows:
+            print(f"Evicting expired job {row['job_id']}")
+            self.delete(row["job_id"])
+
+        with self.connection() as conn:
+            conn.execute("DELETE FROM batches WHERE created < ?",
+                         (time() - self.ttl,))
+
+        partitions = self.connection().execute(
+            "SELECT job_id, path FROM partitions WHERE created < ?", (time() - self.ttl,)).fetchall()
+        for partition in partitions:
+            print(f"Evicting expired partition {partition['job_id']}")
+            with self.connection() as conn:
+                conn.execute("DELETE FROM partitions WHERE job_id = ?",
+                             (partition["job_id"],))
+                conn.execute("DELETE FROM exported_conversations WHERE job_id = ?",
+                             (partition["job_id"],))
+            remove_files(partition["path"])
+        return len(rows) + len(partitions)
+
+    def evict_periodically(self, interval: int) -> None:
+        while True:
+            sleep(interval)
+            try:
+                self.evict_expired()
+            except Exception as e:
+                print(f"Error evicting expired jobs: {e}")
+
+    def heartbeat_periodically(self, interval: int) -> None:
+        while True:
+            sleep(interval)
+            try:
+                with self.connection() as conn:
+                    conn.execute("UPDATE jobs SET updated = ? WHERE worker = ? AND status IN ('queued', 'processing')",
+                                 (time(), self.worker))
+            except Exception as e:
+                print(f"Error refreshing job heartbeats: {e}")
+
+    def fail_stale(self, conn: sqlite3.Connection, job_key: str | None = None) -> None:
+        query = "SELECT job_id FROM jobs WHERE status IN ('queued', 'processing') AND updated < ?"
+        params = [time() - self.heartbeat_timeout]
+        if job_key is not None:
+            query += " AND job_key = ?"
+            params.append(job_key)
+        for row in conn.execute(query, params).fetchall():
+            print(f"Job {row['job_id']} has no heartbeat, its worker is gone")
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE job_id = ?",
+                         ("Worker stopped responding", time(), row["job_id"]))
+
+    def get_watermark(self, tenant: str) -> dict | None:
+        row = self.connection().execute(
+            "SELECT creation, eid FROM watermarks WHERE tenant = ?", (tenant,)).fetchone()
+        return None if row is None else dict(row)
+
+    def set_watermark(self, conn: sqlite3.Connection, tenant: str, creation: str, eid: str | None) -> None:
+        conn.execute("INSERT OR REPLACE INTO watermarks (tenant, creation, eid, updated) VALUES (?, ?, ?, ?)",
+                     (tenant, creation, eid, time()))
+
+    def partition_path(self, tenant: str, job_id: str) -> str:
+        directory = os.path.join(self.directory, "partitions", tenant)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{job_id}.csv")
+
+    def add_partition(self, tenant: str, job_id: str, path: str, rows: int, watermark_from: str | None, watermark_to: str, eid: str | None,
+                      conversations: list[str] = []) -> bool:
+        # The partition, its conversations, the new watermark and the job's completion are saved together, so a run
+        # is never half recorded. Nothing is saved for a job that was cancelled or deleted in the meantime
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] == "cancelled":
+                conn.rollback()
+                return False
+            if rows > 0:
+                conn.execute("INSERT INTO partitions (job_id, tenant, path, rows, watermark_from, watermark_to, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (job_id, tenant, path, rows, watermark_from, watermark_to, time()))
+                conn.executemany("INSERT OR IGNORE INTO exported_conversations (tenant, conversation, job_id) VALUES (?, ?, ?)",
+                                 [(tenant, conversation, job_id) for conversation in conversations])
+            self.set_watermark(conn, tenant, watermark_to, eid)
+            conn.execute("UPDATE jobs SET status = 'completed', updated = ? WHERE job_id = ?",
+                         (time(), job_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return True
+
+    def exported_conversations(self, tenant: str) -> set[str]:
+        rows = self.connection().execute(
+            "SELECT conversation FROM exported_conversations WHERE tenant = ?", (tenant,)).fetchall()
+        return {row["conversation"] for row in rows}
+
+    def list_partitions(self, tenant: str) -> list[dict]:
+        rows = self.connection().execute(
+            "SELECT * FROM partitions WHERE tenant = ? ORDER BY created", (tenant,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def create_batch(self, batch_id: str, tenant_jobs: dict[str, str | None], errors: dict[str, str] = {}) -> None:
+        now = time()
+        with self.connection() as conn:
+            conn.executemany("INSERT INTO batches (batch_id, tenant, job_id, created, error) VALUES (?, ?, ?, ?, ?)",
+                             [(batch_id, tenant, job_id, now, errors.get(tenant)) for tenant, job_id in tenant_jobs.items()])
+
+    def get_batch(self, batch_id: str) -> list[dict]:
+        # Jobs deleted since, e.g. downloaded one-off results, come back with a NULL status
+        rows = self.connection().execute("""SELECT batches.tenant, batches.job_id, jobs.status, COALESCE(jobs.error, batches.error) AS error FROM batches
+            LEFT JOIN jobs ON jobs.job_id = batches.job_id WHERE batches.batch_id = ? ORDER BY batches.tenant""", (batch_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def fail_interrupted(self) -> None:
+        # Jobs left queued or processing by a worker that is no longer running can't finish anymore.
+        # Workers on this host are checked by pid, the ones elsewhere by their heartbeat
+        with self.connection() as conn:
+            self.fail_stale(conn)
+        hostname = socket.gethostname()
+        rows = self.connection().execute(
+            "SELECT job_id, worker FROM jobs WHERE status IN ('queued', 'processing')").fetchall()
+        for row in rows:
+            host, _, pid = (row["worker"] or "").rpartition(":")
+            if host != hostname or not pid.isdigit():
+                continue
+            # Our own pid can only show up here if it was reused after a restart
+            if int(pid) == os.getpid() or not pid_alive(int(pid)):
+                print(f"Job {row['job_id']} was interrupted by a restart")
+                self.update(row["job_id"], status="failed",
+                            error="Interrupted by a restart")
+
+    def remove_result(self, job: dict) -> None:
+        if job["result"]:
+            remove_files(job["result"])
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+
+    def to_dict(self, row: sqlite3.Row | None) -> dict | None:
+        if row is None:
+            return None
+        job = dict(row)
+        job["is_scheduled"] = bool(job["is_scheduled"])
+        if job["progress"] is not None:
+            job["progress"] = json.loads(job["progress"])
+        return job
+
+
+def parquet_path(path: str) -> str:
+    # Typed copy of a CSV result, written next to it by the same job
+    return f"{os.path.splitext(path)[0]}.parquet"
+
+
+def stream_path(path: str) -> str:
+    # Rows of a result as NDJSON, appended as they are processed so they can be streamed before the job ends
+    return f"{os.path.splitext(path)[0]}.ndjson"
+
+
+def remove_files(path: str) -> None:
+    for file in [path, parquet_path(path), stream_path(path)]:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
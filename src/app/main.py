@@ -1,15 +1,24 @@
-from ava import get_graphql, process_graphql, Conv, get_messages, get_exporting_data, get_surveys, send_email
+from ava import REPORT_COLUMNS, graphql_fields, get_graphql_sharded, process_graphql, Watermark, Conv, fetch_conversations, fetch_transcripts, get_messages, get_cached_export, get_surveys, send_email, transcript_cache, user_cache, export_cache
+from jobstore import SQLiteJobStore, parquet_path, stream_path, remove_files
+from exporting import export_formats, transcript_formats, transcripts_zip, transcripts_ndjson, export_to_file, ParquetWriter, PARQUET_MEDIA_TYPE, parquet_available, merge_parquet, content_encodings, compressor
+from scheduler import Scheduler, QueueFull, JobCancelled, PRIORITY_SCHEDULED, PRIORITY_MANUAL
+from metrics import Gauge, CallbackCounter, StageTimer, job_stage_seconds, jobs_total, render
 import logging
+import asyncio
 import sys
 import os
 import csv
-import io
+import json
 import uuid
-from time import sleep
-from datetime import datetime, timedelta
-from openpyxl import Workbook
-from fastapi import FastAPI, BackgroundTasks, Header, HTTPException, Depends, Request
-from fastapi.responses import StreamingResponse
+import hashlib
+from collections.abc import AsyncIterator, Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, time
+from fastapi import FastAPI, Header, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
 
 API_KEY = os.getenv("API_KEY")
 CREDS = os.getenv("CREDS")
@@ -19,6 +28,31 @@ SMTP_CONN = os.getenv("SMTP_CONN")
 SMTP_CREDS = os.getenv("SMTP_CREDS")
 MAIL_TO = os.getenv("MAIL_TO")
 
+JOB_DIR = os.getenv("JOB_DIR", "jobs")
+JOB_TTL = int(os.getenv("JOB_TTL", str(7 * 24 * 3600)))
+# Seconds a finished job is handed out again to identical requests instead of running a new one
+JOB_REUSE_SECONDS = int(os.getenv("JOB_REUSE_SECONDS", "900"))
+# Seconds between sweeps for expired jobs and their files
+JOB_EVICT_SECONDS = int(os.getenv("JOB_EVICT_SECONDS", "600"))
+# Seconds between heartbeats of a worker's unfinished jobs, and without one before a job is taken as interrupted
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_HEARTBEAT_TIMEOUT = int(os.getenv("JOB_HEARTBEAT_TIMEOUT", "300"))
+# Size of the chunks result files are streamed in
+CHUNK_SIZE = 1024 * 1024
+# Max number of blocking upstream calls (ESP, SMTP) running for request handlers at the same time
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+# Jobs running at the same time, jobs waiting in the queue, and jobs running at the same time per tenant
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_TENANT_LIMIT = int(os.getenv("JOB_TENANT_LIMIT", "2"))
+# Running jobs check for cancellation every CANCEL_CHECK_INTERVAL rows
+CANCEL_CHECK_INTERVAL = 20
+# Seconds between saves of a running job's progress, and between checks for new rows while streaming one
+PROGRESS_INTERVAL = 2
+STREAM_POLL_INTERVAL = 0.5
+# Max number of conversations in one bulk transcript export
+BULK_TRANSCRIPTS_MAX = int(os.getenv("BULK_TRANSCRIPTS_MAX", "1000"))
+
 valid_tenants = ["devdev", "tenant1", "tenant1dev", "tenant2",
                  "tenant2dev", "tenant3", "tenant3dev", "tenant4", "tenant4dev"]
 
@@ -45,7 +79,7 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
-def authenticate(x_api_key: str = Header(None, title="API Key", description="Your API Key")) -> bool:
+async def authenticate(x_api_key: str = Header(None, title="API Key", description="Your API Key")) -> bool:
     if x_api_key is None or x_api_key != API_KEY:
         raise HTTPException(
             status_code=401, detail="Missing or invalid API key"
@@ -53,6 +87,13 @@ def authenticate(x_api_key: str = Header(None, title="API Key", description="You
     return True
 
 
+async def authenticate_metrics(x_api_key: str = Header(None), authorization: str = Header(None)) -> bool:
+    # Prometheus can only send an Authorization header, so a bearer API key works here as well
+    if authorization == f"Bearer {API_KEY}":
+        return True
+    return await authenticate(x_api_key)
+
+
 async def verify_tenant(request: Request) -> bool:
     try:
         body = await request.json()
@@ -90,54 +131,500 @@ async def verify_conversation_id(request: Request) -> bool:
     return True
 
 
-def list_of_dicts_to_csv_stringio(data: list[dict]) -> io.StringIO:
-    buffer = io.StringIO()
+def dicts_to_csv_file(data: Iterable[dict], path: str) -> int:
+    # Rows are appended as they arrive, under a temporary name so a half-written file is never served.
+    # Every row also goes to an NDJSON file that can be streamed while the job runs, and
+    # with pyarrow installed a typed Parquet copy is written in the same pass. The copy is
+    # optional, if it fails it's dropped and the job carries on with the CSV
+    count = 0
+    paths = [path, stream_path(path)]
+    parquet = None
+    if parquet_available():
+        paths.append(parquet_path(path))
+        parquet = ParquetWriter(f"{paths[2]}.part")
+    try:
+        with open(f"{path}.part", "w", newline="", encoding="utf-8") as f, open(f"{paths[1]}.part", "w", encoding="utf-8") as stream:
+            writer = None
+            for d in data:
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=d.keys())
+                    writer.writeheader()
+                writer.writerow(d)
+                stream.write(json.dumps(d, default=str) + "\n")
+                stream.flush()
+                if parquet is not None:
+                    try:
+                        parquet.write(d)
+                    except Exception as e:
+                        parquet = drop_parquet(parquet, paths, e)
+                count += 1
+        if parquet is not None:
+            try:
+                parquet.close()
+            except Exception as e:
+                parquet = drop_parquet(parquet, paths, e)
+    except Exception:
+        if parquet is not None:
+            parquet.abort()
+        remove_parts(paths)
+        raise
+
+    if count == 0:
+        remove_parts(paths)
+    else:
+        for file in paths:
+            os.replace(f"{file}.part", file)
+    return count
+
 
-    writer = csv.DictWriter(buffer, fieldnames=data[0].keys())
-    writer.writeheader()
-    for d in data:
-        writer.writerow(d)
+def drop_parquet(parquet: ParquetWriter, paths: list[str], error: Exception) -> None:
+    print(f"Error writing {parquet.path}, dropping the Parquet copy: {error}")
+    parquet.abort()
+    paths.remove(parquet.path.removesuffix(".part"))
 
-    # Go back to the start of the StringIO object to get the CSV data
-    buffer.seek(0)
-    return buffer
 
+def remove_parts(paths: list[str]) -> None:
+    for file in paths:
+        if os.path.exists(f"{file}.part"):
+            os.remove(f"{file}.part")
 
-def process_reporting_data_and_update_job(job_id: str, data: dict, tenant: str, token: str) -> None:
-    list_of_convs = []
-    results = []
-    for index, item in enumerate(process_graphql(data)):
-        list_of_convs.append(Conv(index + 1, item, job_id, tenant, token))
-        results.append(list_of_convs[index].to_dict())
-        # print("ZzzZZ...")
-        sleep(1)
 
-    print(f"Done. Processed {len(results)} items")
+blocking_executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
 
-    # Generate the CSV data
+
+async def run_blocking(func: Callable, *args):
+    # Handlers are async, so anything that waits on the network or disk runs in the bounded executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, partial(func, *args))
+
+
+async def iterate_blocking(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    # Each step of a blocking generator runs in the executor. When the client goes away the generator
+    # is closed there as well, once the step still running is done, so its cleanup never blocks the loop
+    step = None
     try:
-        buffer = list_of_dicts_to_csv_stringio(results)
-        jobs[job_id]["status"] = "completed"
-        # Store the CSV data as a string
-        jobs[job_id]["data"] = buffer.getvalue()
-    except IndexError:
-        print("Stopping job, no items to process")
-        del jobs[job_id]
+        while True:
+            step = asyncio.ensure_future(run_blocking(next, chunks, None))
+            chunk = await asyncio.shield(step)
+            if chunk is None:
+                break
+            if chunk:
+                yield chunk
+    finally:
+        if step is not None and not step.done():
+            await asyncio.wait([step])
+        await run_blocking(chunks.close)
+
+
+async def iterfile(path: str, skip_header: bool = False) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        if skip_header:
+            await run_blocking(f.readline)
+        while chunk := await run_blocking(f.read, CHUNK_SIZE):
+            yield chunk
+
+
+async def iterrows(job_id: str, candidates: list[str]) -> AsyncIterator[bytes]:
+    # Follows the NDJSON rows of a job as they are written, until the job is done
+    f = None
+    while f is None:
+        for path in candidates:
+            try:
+                f = open(path, "rb")
+                break
+            except FileNotFoundError:
+                pass
+        if f is None:
+            job = await run_blocking(jobs.get, job_id)
+            if job is None or not is_pending(job):
+                return
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+    with f:
+        buffer = b""
+        while True:
+            job = await run_blocking(jobs.get, job_id)
+            done = job is None or not is_pending(job)
+            # Only whole lines are sent, the rest waits for the writer to finish it
+            while chunk := await run_blocking(f.read, CHUNK_SIZE):
+                lines, newline, buffer = (buffer + chunk).rpartition(b"\n")
+                if newline:
+                    yield lines + newline
+            if done:
+                break
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+    if job is not None and job["status"] in ("failed", "cancelled"):
+        # Breaks the chunked response, so clients don't take a partial stream for a complete one
+        raise Exception(f"Job {job_id} {job['status']}")
+
+
+async def timed_download(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    start = perf_counter()
+    async for chunk in chunks:
+        yield chunk
+    job_stage_seconds.observe(perf_counter() - start, "download")
+
+
+async def compress(chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+    compressobj = compressor(encoding)
+    async for chunk in chunks:
+        if data := await run_blocking(compressobj.compress, chunk):
+            yield data
+    yield compressobj.flush()
+
+
+def negotiate(request: Request) -> tuple[str, str | None]:
+    # Downloads are CSV unless Parquet is asked for in Accept, compressed if Accept-Encoding allows it
+    accept = request.headers.get("accept", "")
+    if PARQUET_MEDIA_TYPE in accept or "application/x-parquet" in accept:
+        if not parquet_available():
+            raise HTTPException(
+                status_code=406, detail="Parquet downloads are not available")
+        return "parquet", None
+
+    accepted = []
+    for item in request.headers.get("accept-encoding", "").split(","):
+        encoding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.append(encoding.strip().lower())
+    for encoding in content_encodings():
+        if encoding in accepted:
+            return "csv", encoding
+    return "csv", None
+
+
+def download_response(chunks: AsyncIterator[bytes], name: str, format: str, encoding: str | None, background: BackgroundTask) -> StreamingResponse:
+    if encoding is not None:
+        chunks = compress(chunks, encoding)
+    media_type = PARQUET_MEDIA_TYPE if format == "parquet" else "text/csv"
+    response = StreamingResponse(timed_download(
+        chunks), media_type=media_type, background=background)
+
+    # Add a Content-Disposition header to prompt the file download
+    response.headers["Content-Disposition"] = f"attachment; filename={name}.{format}"
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def result_response(job: dict, name: str, format: str, encoding: str | None) -> StreamingResponse:
+    # Stream the result file, the job is removed once it's sent and can't be reused anymore
+    path = job["result"] if format == "csv" else parquet_path(job["result"])
+    if not os.path.exists(path):
+        raise HTTPException(
+            status_code=406, detail=f"No {format} result for job {job['job_id']}")
+    return download_response(iterfile(path), name, format, encoding, BackgroundTask(jobs.mark_downloaded, job["job_id"]))
+
+
+async def partitions_response(tenant: str, partitions: list[dict], format: str, encoding: str | None) -> StreamingResponse:
+    paths = [partition["path"] for partition in partitions]
+    if format == "parquet":
+        paths = [parquet_path(path) for path in paths]
+        if not all(os.path.exists(path) for path in paths):
+            raise HTTPException(
+                status_code=406, detail=f"No parquet data for some partitions of '{tenant}'")
+        # Parquet files can't be concatenated, so the partitions are merged into a temporary file
+        path = await run_blocking(merge_parquet, paths)
+        response = download_response(iterfile(
+            path), f"{tenant}_pbi", format, encoding, BackgroundTask(os.remove, path))
+    else:
+        # Create a generator to stream all partitions as one CSV file
+        async def iterpartitions():
+            for index, path in enumerate(paths):
+                if os.path.exists(path):
+                    # Every partition starts with the same header, only the first one is kept
+                    async for chunk in iterfile(path, skip_header=index > 0):
+                        yield chunk
+
+        response = download_response(
+            iterpartitions(), f"{tenant}_pbi", format, encoding, None)
+
+    # Clients pass it back as 'since' to only get the data added after this download
+    response.headers["X-Watermark"] = partitions[-1]["watermark_to"]
+    return response
+
+
+async def submit_job(job_id: str, tenant: str | None, priority: int, func: Callable, *args) -> None:
+    # Called on the event loop, where the scheduler keeps its bookkeeping
+    try:
+        scheduler.submit(job_id, tenant, priority, func, *args)
+    except QueueFull as e:
+        await run_blocking(jobs.delete, job_id)
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": "60"})
+
+
+class Progress():
+    # Counts of a running job, saved to the job store every PROGRESS_INTERVAL seconds so any worker can report them
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.started = time()
+        self.saved = 0.0
+        self.total = 0
+        self.total_known = False
+        self.processed = 0
+        self.failures = 0
+
+    def count_total(self, conversations: Iterable[dict]) -> Iterator[dict]:
+        # Conversations are discovered page by page, the total is only final once the last page is in
+        for conversation in conversations:
+            self.total += 1
+            yield conversation
+        self.total_known = True
+        self.save(force=True)
+
+    def count_processed(self, convs: Iterable[Conv]) -> Iterator[Conv]:
+        for conv in convs:
+            self.processed += 1
+            if conv.failed:
+                self.failures += 1
+            self.save()
+            yield conv
+
+    def save(self, force: bool = False) -> None:
+        if not force and time() - self.saved < PROGRESS_INTERVAL:
+            return
+        self.saved = time()
+        jobs.update(self.job_id, progress=json.dumps({
+            "started": self.started,
+            "total": self.total,
+            "total_known": self.total_known,
+            "processed": self.processed,
+            "failures": self.failures
+        }))
+
+
+def progress_report(job: dict) -> dict | None:
+    progress = job["progress"]
+    if progress is None:
+        return None
+    elapsed = (time() if is_pending(job) else job["updated"]) - \
+        progress["started"]
+    rate = progress["processed"] / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if progress["total_known"] and rate > 0 and is_pending(job):
+        eta = (progress["total"] - progress["processed"]) / rate
+    return {**progress, "rows_per_second": rate, "eta_seconds": eta}
+
+
+def start_running(job_id: str) -> dict | None:
+    # A job cancelled while it was queued, possibly by another worker, is not started
+    job = jobs.get(job_id)
+    if job is None or not jobs.update_unless_cancelled(job_id, status="processing"):
+        print(f"[{job_id}] Job was cancelled before it started")
+        return None
+    return job
+
+
+def until_cancelled(job_id: str, rows: Iterable[dict]) -> Iterable[dict]:
+    for index, row in enumerate(rows):
+        if index % CANCEL_CHECK_INTERVAL == 0 and jobs.get(job_id)["status"] == "cancelled":
+            raise JobCancelled(f"Job {job_id} cancelled")
+        yield row
+
+
+def job_key(kind: str, tenant: str, filter: dict | None, columns: tuple[str, ...] = REPORT_COLUMNS) -> str:
+    # Requests for the same tenant, filter and columns, in any key order, share a job
+    normalized = json.dumps(filter, sort_keys=True, separators=(",", ":"))
+    if columns != REPORT_COLUMNS:
+        normalized += "|" + ",".join(columns)
+    return hashlib.sha256(f"{kind}|{tenant}|{normalized}".encode()).hexdigest()
+
+
+def report_columns(body: dict) -> tuple[str, ...]:
+    # Requested columns in REPORT_COLUMNS order, all of them when the body has none
+    columns = body.get("columns")
+    if columns is None:
+        return REPORT_COLUMNS
+    if not isinstance(columns, list) or not columns or not all(isinstance(column, str) for column in columns):
+        raise HTTPException(
+            status_code=400, detail="'columns' must be a non-empty list of column names")
+    unknown = [column for column in columns if column not in REPORT_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown columns {unknown}, available: {list(REPORT_COLUMNS)}")
+    return tuple(column for column in REPORT_COLUMNS if column in columns)
+
 
+def pbi_columns(body: dict) -> tuple[str, ...]:
+    columns = report_columns(body)
+    # Incremental partitions are concatenated on download, so they all keep the full schema
+    if columns != REPORT_COLUMNS and body.get("filter") is None:
+        raise HTTPException(
+            status_code=400, detail="'columns' needs a 'filter', incremental PBI runs export every column")
+    return columns
+
+
+def as_utc(value: str) -> datetime:
+    # Watermarks and 'since' values without a timezone, plain dates included, are taken as UTC
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def is_pending(job: dict) -> bool:
+    return job["status"] in ("queued", "processing")
+
+
+def process_reporting_data_and_update_job(job_id: str, filter: dict, tenant: str, watermark: Watermark | None = None,
+                                          columns: tuple[str, ...] = REPORT_COLUMNS) -> None:
+    job = start_running(job_id)
+    if job is None:
+        return
+    kind = "pbi" if job["is_scheduled"] else "reporting"
+    if watermark is None:
+        path = jobs.result_path(job_id)
+    else:
+        path = jobs.partition_path(tenant, job_id)
+    timer = StageTimer()
+    progress = Progress(job_id)
+    try:
+        # Interactions are streamed page by page, so transcripts are fetched while later pages download
+        nodes = timer.wrap("graphql_fetch", get_graphql_sharded(
+            tenant, CREDS, filter, graphql_fields(columns)))
+        exported = None
+        if watermark is not None:
+            # Incremental PBI run, interactions and conversations extracted by previous runs are skipped
+            nodes = watermark.newer(nodes)
+            exported = jobs.exported_conversations(tenant)
+        conversations = timer.wrap("dedup", process_graphql(nodes, exported))
+        if watermark is not None:
+            conversations = watermark.record(conversations)
+        conversations = progress.count_total(conversations)
+        rows = (conv.to_dict() for conv in progress.count_processed(timer.wrap("transcript_fetch", fetch_conversations(
+            conversations, job_id, tenant, CREDS, columns))))
+        timer.enter("csv_write")
+        try:
+            count = dicts_to_csv_file(until_cancelled(job_id, rows), path)
+        finally:
+            timer.exit()
+    except JobCancelled:
+        print(f"[{job_id}] Job cancelled")
+        jobs_total.inc(kind, "cancelled")
+        return
+    except Exception as e:
+        print(f"[{job_id}] Job failed: {e}")
+        failed = jobs.update_unless_cancelled(
+            job_id, status="failed", error=str(e))
+        jobs_total.inc(kind, "failed" if failed else "cancelled")
+        return
+
+    print(f"Done. Processed {count} items")
+    progress.save(force=True)
+    timer.observe(job_stage_seconds)
+
+    # Cancellation is only checked every CANCEL_CHECK_INTERVAL rows, so a DELETE can still land here.
+    # The job then stays cancelled, its result is dropped and the watermark doesn't move
+    if watermark is not None and watermark.creation is not None:
+        completed = jobs.add_partition(tenant, job_id, path, count, watermark.start,
+                                       watermark.creation, watermark.eid, watermark.conversations)
+    elif watermark is not None:
+        completed = jobs.update_unless_cancelled(job_id, status="completed")
+    elif count == 0:
+        print("Stopping job, no items to process")
+        jobs.delete(job_id)
+        completed = True
+    else:
+        completed = jobs.update_unless_cancelled(
+            job_id, status="completed", result=path)
+
+    if not completed:
+        print(f"[{job_id}] Job cancelled")
+        remove_files(path)
+        jobs_total.inc(kind, "cancelled")
+        return
+    if watermark is not None and watermark.creation is not None:
+        print(f"[{job_id}] Watermark for {tenant}: {watermark.creation}")
+    jobs_total.inc(kind, "completed")
+
+
+async def start_pbi(tenant: str, filter: dict | None = None, columns: tuple[str, ...] = REPORT_COLUMNS) -> dict:
+    today = datetime.today().date()
+    yesterday = today - timedelta(days=1)
 
-def get_surveys_and_send_email(job_id: str, CREDS: str) -> None:
+    # Incremental runs of a tenant share one key, so a second one attaches to the running one
+    key = job_key("pbi", tenant, filter, columns)
+    if filter is not None:
+        watermark = None
+    else:
+        # Incremental run, only interactions created after the tenant's watermark are extracted
+        watermark = Watermark(**(await run_blocking(jobs.get_watermark, tenant) or {}))
+        start = datetime.fromisoformat(
+            watermark.start).date() if watermark.start else yesterday
+        # ESP is queried by date, Watermark.newer drops what's older than the watermark on that day.
+        # The range ends tomorrow so interactions created today are included
+        filter = {"createdDateRange": [
+            f"{start}", f"{today + timedelta(days=1)}"]}
+
+    job, created = await run_blocking(jobs.find_or_create, str(uuid.uuid4()), tenant, key, True)
+    job_id = job["job_id"]
+    if created:
+        await submit_job(job_id, tenant, PRIORITY_SCHEDULED,
+                   process_reporting_data_and_update_job, job_id, filter, tenant, watermark, columns)
+    else:
+        print(f"[{job_id}] PBI job for {tenant} already running, attached to it")
+    return {"job_id": job_id, "is_scheduled": True, "tenant": tenant, "since": watermark.start if watermark else None, "attached": not created, "status": job["status"]}
+
+
+def export_resource(tenant: str, resource: str, format: str) -> tuple[str, str, str]:
+    # Each version of an export is rendered once per format and kept next to its cached rows
+    entry, state = get_cached_export(tenant, CREDS, resource)
+    path = export_cache.file_path(entry, format)
+    if not os.path.exists(path):
+        rendered = export_to_file(export_cache.rows(
+            entry), format, os.path.dirname(path))
+        os.replace(rendered, path)
+    return path, f'"{entry["etag"]}-{format}"', state
+
+
+async def get_surveys_and_send_email(job_id: str, CREDS: str) -> None:
+    if await run_blocking(start_running, job_id) is None:
+        return
     today = datetime.today().date()
     yesterday = today - timedelta(days=1)
     filename = f"live_chat_interaction_feedback_{yesterday}.csv"
-    data = get_surveys(CREDS, today, yesterday)
-    print("Done. Got the surveys")
-    send_email(SMTP_CONN, SMTP_CREDS, MAIL_TO, data, yesterday, filename)
-    del jobs[job_id]
+    try:
+        data = await get_surveys(CREDS, today, yesterday)
+        print("Done. Got the surveys")
+        await run_blocking(send_email, SMTP_CONN, SMTP_CREDS, MAIL_TO, data, yesterday, filename)
+    except Exception as e:
+        print(f"[{job_id}] Job failed: {e}")
+        await run_blocking(partial(jobs.update, job_id, status="failed", error=str(e)))
+        jobs_total.inc("surveys", "failed")
+        return
+    jobs_total.inc("surveys", "completed")
+    await run_blocking(jobs.delete, job_id)
 
 
 app = FastAPI()
-# In-memory storage for job statuses and results
-jobs: dict[str, dict] = {}
+# Job statuses in SQLite, results as files on disk
+jobs = SQLiteJobStore(JOB_DIR, JOB_TTL, JOB_REUSE_SECONDS, JOB_EVICT_SECONDS,
+                      JOB_HEARTBEAT_SECONDS, JOB_HEARTBEAT_TIMEOUT)
+scheduler = Scheduler(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TENANT_LIMIT)
+
+Gauge("job_queue_depth", "Jobs waiting in the scheduler queue",
+      scheduler.queue_depth)
+Gauge("jobs_running", "Jobs currently running", lambda: scheduler.active)
+CallbackCounter("transcript_cache_hits_total", "Conversations served from the transcript cache",
+                lambda: transcript_cache.hits)
+CallbackCounter("transcript_cache_misses_total", "Conversations fetched from ESP",
+                lambda: transcript_cache.misses)
+CallbackCounter("user_cache_hits_total", "User names served from the user cache",
+                lambda: user_cache.hits)
+CallbackCounter("user_cache_misses_total", "User names fetched from ESP",
+                lambda: user_cache.misses)
 
 
 # root
@@ -146,12 +633,18 @@ async def read_root(request: Request, api_key: bool = Depends(authenticate)) ->
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
 
-    return {"message": "Welcome to AVA Team API", "memory": f"{len(jobs.keys())} jobs: {list(jobs.keys())}"}
+    job_ids = await run_blocking(jobs.list_ids)
+    return {"message": "Welcome to AVA Team API", "memory": f"{len(job_ids)} jobs: {job_ids}"}
+
+
+@app.get("/metrics")
+async def get_metrics(api_key: bool = Depends(authenticate_metrics)) -> PlainTextResponse:
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
 
 
 # reporting
 @app.post("/reporting/start_job/")
-async def start_job(background_tasks: BackgroundTasks, request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> dict:
+async def start_job(request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> dict:
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
 
@@ -163,91 +656,170 @@ async def start_job(background_tasks: BackgroundTasks, request: Request, api_key
         filter = body["filter"]
     except:
         filter = {"createdDateRange": ["2024-03-25", "2024-03-31"]}
+    columns = report_columns(body)
 
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "processing"}
-
-    result_object = get_graphql(tenant, CREDS, filter)
-    csv_data = result_object["data"]
-    token = result_object["token"]
-
-    background_tasks.add_task(
-        process_reporting_data_and_update_job, job_id, csv_data, tenant, token)
-    return {"job_id": job_id}
+    job, created = await run_blocking(jobs.find_or_create, str(uuid.uuid4()), tenant, job_key("reporting", tenant, filter, columns))
+    job_id = job["job_id"]
+    if created:
+        await submit_job(job_id, tenant, PRIORITY_MANUAL,
+                   process_reporting_data_and_update_job, job_id, filter, tenant, None, columns)
+    else:
+        print(f"[{job_id}] Same tenant and filter, attached to job ({job['status']})")
+    return {"job_id": job_id, "attached": not created}
 
 
 @app.get("/reporting/job_status/{job_id}/")
 async def get_status(job_id: str, request: Request, api_key: bool = Depends(authenticate)) -> dict:
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
-    if job_id not in jobs:
+    job = await run_blocking(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {"status": job["status"], "progress": progress_report(job)}
+
+
+@app.get("/reporting/stream/{job_id}/")
+async def stream_rows(job_id: str, request: Request, api_key: bool = Depends(authenticate)) -> StreamingResponse:
+    if LOG_MODE:
+        logger.info(f"Headers:\n${request.headers}")
+    job = await run_blocking(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    # Incremental PBI runs write to their partition instead of a result file
+    results = [jobs.result_path(job_id)]
+    if job["is_scheduled"] and job["tenant"] is not None:
+        results.append(await run_blocking(jobs.partition_path, job["tenant"], job_id))
+    candidates = [f"{stream_path(result)}{suffix}" for result in results for suffix in [
+        ".part", ""]]
+    return StreamingResponse(iterrows(job_id, candidates), media_type="application/x-ndjson")
+
+
+@app.delete("/reporting/job/{job_id}")
+async def cancel_job(job_id: str, request: Request, api_key: bool = Depends(authenticate)) -> dict:
+    if LOG_MODE:
+        logger.info(f"Headers:\n${request.headers}")
+    job = await run_blocking(jobs.get, job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
 
-    job_status = jobs[job_id]["status"]
-    return {"status": job_status}
+    # Identical requests share one job (see 'attached' in start_job), so this cancels or deletes
+    # it for every caller attached to it, not only the one that started it
+    if not is_pending(job):
+        # Finished jobs are removed along with their result
+        await run_blocking(jobs.delete, job_id)
+        return {"job_id": job_id, "status": "deleted"}
+
+    # Queued jobs are dropped right away, running ones stop at their next cancellation check
+    if not await run_blocking(jobs.cancel, job_id):
+        # It finished or was deleted since it was read
+        job = await run_blocking(jobs.get, job_id)
+        return {"job_id": job_id, "status": job["status"] if job is not None else "deleted"}
+    if scheduler.cancel(job_id):
+        return {"job_id": job_id, "status": "cancelled"}
+    return {"job_id": job_id, "status": "cancelling"}
 
 
 @app.get("/reporting/download/{job_id}/")
 async def download_csv(job_id: str, request: Request, api_key: bool = Depends(authenticate)) -> StreamingResponse:
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
-    if job_id not in jobs:
+    job = await run_blocking(jobs.get, job_id)
+    if job is None:
         raise HTTPException(
             status_code=404, detail="Job not found or still processing")
-    if jobs[job_id]["status"] == "processing":
+    if is_pending(job):
         raise HTTPException(
             status_code=425, detail="Too early, still processing job")
+    if job["status"] == "cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    if job["status"] == "failed":
+        raise HTTPException(
+            status_code=502, detail=f"Job failed: {job['error']}")
 
-    csv_data = jobs[job_id]["data"]
-
-    # Create a generator to stream the CSV data
-    def iterfile():
-        buffer = io.StringIO(csv_data)
-        yield from buffer
-
-    # Create a streaming response to stream the CSV data
-    response = StreamingResponse(
-        iterfile(), media_type="text/csv")
-
-    # Add a Content-Disposition header to prompt the file download
-    response.headers["Content-Disposition"] = f"attachment; filename={
-        job_id}.csv"
-
-    # Clean memory
-    del jobs[job_id]
-
-    return response
+    format, encoding = negotiate(request)
+    return result_response(job, job_id, format, encoding)
 
 
 # pbi
 @app.post("/pbi/start_job/")
-async def start_pbi_job(background_tasks: BackgroundTasks, request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> dict:
+async def start_pbi_job(request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> dict:
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
 
-    today = datetime.today().date()
-    yesterday = today - timedelta(days=1)
-
     body = await request.json()
     tenant = body["tenant"]
     print(f"PBI JOB for {tenant}")
 
-    try:
-        filter = body["filter"]
-    except:
-        filter = {"createdDateRange": [f"{yesterday}", f"{today}"]}
+    return await start_pbi(tenant, body.get("filter"), pbi_columns(body))
 
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"is_scheduled": True,
-                    "status": "processing", "tenant": tenant}
 
-    result_object = get_graphql(tenant, CREDS, filter)
-    csv_data = result_object["data"]
-    token = result_object["token"]
+@app.post("/pbi/start_batch/")
+async def start_pbi_batch(request: Request, api_key: bool = Depends(authenticate)) -> dict:
+    if LOG_MODE:
+        logger.info(f"Headers:\n${request.headers}")
+
+    try:
+        body = await request.json()
+    except:
+        body = {}
+    tenants = body.get("tenants") or valid_tenants
+    if not isinstance(tenants, list) or not all(isinstance(tenant, str) for tenant in tenants):
+        raise HTTPException(
+            status_code=400, detail="'tenants' must be a list of tenant names")
+    unsupported = [tenant for tenant in tenants if tenant not in valid_tenants]
+    if unsupported:
+        raise HTTPException(
+            status_code=403, detail=f"Tenants {unsupported} not supported")
+
+    columns = pbi_columns(body)
+    # Every tenant gets its own job, ESP calls of all of them share the ESP_MAX_IN_FLIGHT budget in ava
+    batch_id = str(uuid.uuid4())
+    tenant_jobs = {}
+    errors = {}
+    statuses = {}
+    for tenant in dict.fromkeys(tenants):
+        try:
+            job = await start_pbi(tenant, body.get("filter"), columns)
+            tenant_jobs[tenant] = job["job_id"]
+            statuses[tenant] = {"job_id": job["job_id"],
+                                "status": job["status"], "attached": job["attached"]}
+        except HTTPException as e:
+            # No room in the queue, the rest of the batch still starts
+            tenant_jobs[tenant] = None
+            errors[tenant] = e.detail
+            statuses[tenant] = {"job_id": None,
+                                "status": "rejected", "error": e.detail}
+    await run_blocking(jobs.create_batch, batch_id, tenant_jobs, errors)
+    print(f"PBI batch {batch_id} for {list(tenant_jobs)}")
+    return {"batch_id": batch_id, "tenants": statuses}
+
+
+@app.get("/pbi/batch/{batch_id}/")
+async def get_pbi_batch(batch_id: str, request: Request, api_key: bool = Depends(authenticate)) -> dict:
+    if LOG_MODE:
+        logger.info(f"Headers:\n${request.headers}")
 
-    background_tasks.add_task(
-        process_reporting_data_and_update_job, job_id, csv_data, tenant, token)
-    return {"job_id": job_id, "is_scheduled": jobs[job_id]["is_scheduled"], "tenant": tenant}
+    rows = await run_blocking(jobs.get_batch, batch_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    statuses = {}
+    for row in rows:
+        status = row["status"] or ("deleted" if row["job_id"] else "rejected")
+        statuses[row["tenant"]] = {"job_id": row["job_id"],
+                                   "status": status, "error": row["error"]}
+    values = [tenant["status"] for tenant in statuses.values()]
+    if any(status in ("queued", "processing") for status in values):
+        status = "processing"
+    elif all(status == "completed" for status in values):
+        status = "completed"
+    elif any(status == "completed" for status in values):
+        status = "partially_completed"
+    else:
+        status = "failed"
+    return {"batch_id": batch_id, "status": status, "tenants": statuses}
 
 
 @app.get("/pbi/download/")
@@ -257,38 +829,35 @@ async def download_pbi_csv(request: Request, api_key: bool = Depends(authenticat
 
     body = await request.json()
     tenant = body["tenant"]
+    since = body.get("since")
+    format, encoding = negotiate(request)
 
-    job_id = ""
-    for id, job_info in jobs.items():
-        if "tenant" in job_info and job_info["tenant"] == tenant:
-            job_id = id
-
-    if job_id == "":
-        raise HTTPException(status_code=403, detail=f"No jobs for '{tenant}'")
+    job = await run_blocking(jobs.latest_for_tenant, tenant)
+    # PBI jobs started with an explicit filter are served on their own
+    if job is not None and job["status"] == "completed" and job["result"] is not None and job["downloaded"] is None:
+        return result_response(job, job["job_id"], format, encoding)
 
-    if jobs[job_id]["status"] == "processing":
+    try:
+        partitions = [partition for partition in await run_blocking(jobs.list_partitions, tenant) if since is None or as_utc(
+            partition["watermark_to"]) > as_utc(since)]
+    except (TypeError, ValueError):
         raise HTTPException(
-            status_code=425, detail="Too early, still processing job")
-
-    csv_data = jobs[job_id]["data"]
-
-    # Create a generator to stream the CSV data
-    def iterfile():
-        buffer = io.StringIO(csv_data)
-        yield from buffer
-
-    # Create a streaming response to stream the CSV data
-    response = StreamingResponse(
-        iterfile(), media_type="text/csv")
-
-    # Add a Content-Disposition header to prompt the file download
-    response.headers["Content-Disposition"] = f"attachment; filename={
-        job_id}.csv"
+            status_code=400, detail="'since' must be a watermark returned in X-Watermark")
+
+    if not partitions:
+        if job is None:
+            raise HTTPException(
+                status_code=403, detail=f"No jobs for '{tenant}'")
+        if is_pending(job):
+            raise HTTPException(
+                status_code=425, detail="Too early, still processing job")
+        if job["status"] == "failed":
+            raise HTTPException(
+                status_code=502, detail=f"Job failed: {job['error']}")
+        raise HTTPException(
+            status_code=404, detail=f"No new data for '{tenant}'")
 
-    # Clean memory
-    del jobs[job_id]
-
-    return response
+    return await partitions_response(tenant, partitions, format, encoding)
 
 
 # exporting
@@ -303,7 +872,7 @@ async def start_transcript(request: Request, api_key: bool = Depends(authenticat
     print(body["tenant"])
 
     try:
-        transcript = get_messages(tenant, CREDS, conversation_id)
+        transcript = await run_blocking(get_messages, tenant, CREDS, conversation_id)
         print("Returning data...")
     except IndexError:
         print(f"404 - Conversation {conversation_id} not found")
@@ -316,27 +885,59 @@ async def start_transcript(request: Request, api_key: bool = Depends(authenticat
             status_code=400, detail=f"Conversation id: '{conversation_id}' is in wrong format or ESP API error")
 
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "processing"}
+    await run_blocking(jobs.create, job_id)
 
     # Create a generator to stream the CSV data
-    def iterfile():
-        buffer = io.StringIO(transcript)
-        yield from buffer
+    async def itertranscript():
+        yield transcript
 
     # Create a streaming response to stream the CSV data
     response = StreamingResponse(
-        iterfile(), media_type="text/csv")
+        itertranscript(), media_type="text/csv")
 
     # Add a Content-Disposition header to prompt the file download
     response.headers["Content-Disposition"] = f"attachment; filename={
         tenant}_{conversation_id}_transcript.txt"
 
     # Clean memory
-    del jobs[job_id]
+    await run_blocking(jobs.delete, job_id)
 
     return response
 
 
+@app.post("/exporting/transcripts/")
+async def start_bulk_transcripts(request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> StreamingResponse:
+    if LOG_MODE:
+        logger.info(f"Headers:\n${request.headers}")
+
+    body = await request.json()
+    tenant = body["tenant"]
+    conversation_ids = body.get("conversation_ids")
+    format = body.get("format", "zip")
+    if not isinstance(conversation_ids, list) or not conversation_ids:
+        raise HTTPException(
+            status_code=400, detail="'conversation_ids' must be a non-empty list")
+    conversation_ids = list(dict.fromkeys(str(i) for i in conversation_ids))
+    if len(conversation_ids) > BULK_TRANSCRIPTS_MAX:
+        raise HTTPException(
+            status_code=400, detail=f"At most {BULK_TRANSCRIPTS_MAX} conversations per request")
+    if format not in transcript_formats:
+        raise HTTPException(
+            status_code=400, detail=f"Format {format} not available, use one of {list(transcript_formats)}")
+    print(f"Bulk transcripts for {tenant}: {len(conversation_ids)} conversations")
+
+    # Transcripts are fetched concurrently and written to the response as they finish,
+    # conversations that failed are listed in the manifest instead
+    manifest = {"tenant": tenant, "requested": len(conversation_ids),
+                "succeeded": [], "errors": {}}
+    results = fetch_transcripts(tenant, CREDS, conversation_ids)
+    if format == "zip":
+        chunks = transcripts_zip(results, manifest)
+    else:
+        chunks = transcripts_ndjson(results, manifest)
+    return StreamingResponse(iterate_blocking(chunks), media_type=transcript_formats[format], headers={"Content-Disposition": f"attachment; filename={tenant}_transcripts.{format}"})
+
+
 @app.post("/exporting/{resource}/")
 async def start_exporting_job(resource: str, request: Request, api_key: bool = Depends(authenticate), body=Depends(verify_tenant)) -> StreamingResponse:
     if LOG_MODE:
@@ -350,47 +951,45 @@ async def start_exporting_job(resource: str, request: Request, api_key: bool = D
 
     body = await request.json()
     tenant = body["tenant"]
+    format = body.get("format", "xlsx")
     print(body["tenant"])
     print(resource)
 
-    data = get_exporting_data(tenant, CREDS, resource)
-    print("Returning data...")
+    if format not in export_formats:
+        raise HTTPException(
+            status_code=400, detail=f"Format {format} not available, use one of {list(export_formats)}")
 
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "processing"}
-
-    # Create an in-memory bytes buffer
-    output = io.BytesIO()
-
-    # Create an XLSX file in the buffer
-    wb = Workbook()
-    ws = wb.active
-    headers = data[0].keys()
-    ws.append(list(headers))
-    # Write data rows
-    for row in data:
-        row_values = [str(value) for value in row.values()]
-        ws.append(row_values)
-
-    # Save the workbook to the buffer
-    wb.save(output)
-    # Seek to the start of the BytesIO buffer
-    output.seek(0)
+    await run_blocking(jobs.create, job_id)
+
+    # Fetching and writing the file runs in the blocking executor so the event loop stays free
+    try:
+        path, etag, state = await run_blocking(export_resource, tenant, resource, format)
+    except Exception as e:
+        print(f"Export of {resource} for {tenant} failed: {e}")
+        await run_blocking(jobs.delete, job_id)
+        raise HTTPException(
+            status_code=502, detail=f"Export of {resource} failed: {e}")
+    print(f"Returning data... (cache {state})")
 
     # Clean memory
-    del jobs[job_id]
+    await run_blocking(jobs.delete, job_id)
+
+    headers = {"ETag": etag, "X-Cache": state}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
 
-    # Create a StreamingResponse to stream the XLSX file
-    return StreamingResponse(output, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": f"attachment; filename={tenant}_{resource}.xlsx"})
+    # Create a StreamingResponse to stream the cached file
+    return StreamingResponse(iterfile(path), media_type=export_formats[format], headers={**headers, "Content-Disposition": f"attachment; filename={tenant}_{resource}.{format}"})
 
 
 @app.post("/surveys/")
-async def start_surveys_job(background_tasks: BackgroundTasks, request: Request, api_key: bool = Depends(authenticate)) -> dict:
+async def start_surveys_job(request: Request, api_key: bool = Depends(authenticate)) -> dict:
     if LOG_MODE:
         logger.info(f"Headers:\n${request.headers}")
 
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "processing"}
-    background_tasks.add_task(
-        get_surveys_and_send_email, job_id, CREDS)
+    await run_blocking(jobs.create, job_id)
+    await submit_job(job_id, None, PRIORITY_SCHEDULED,
+               get_surveys_and_send_email, job_id, CREDS)
     return {"job_id": job_id}
@@ -0,0 +1,146 @@
+import threading
+from bisect import bisect_left
+from collections.abc import Callable, Iterable, Iterator
+from time import perf_counter
+
+# Minimal Prometheus text format metrics, kept per process
+UPSTREAM_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1, 2.5, 5, 10, 30, 60, 120]
+STAGE_BUCKETS = [0.1, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400]
+
+registry: list = []
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter():
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(
+                    f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge():
+    # Read from a callback when metrics are rendered
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        registry.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.callback()}"]
+
+
+class CallbackCounter(Gauge):
+    # A running total kept elsewhere, read when metrics are rendered
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.callback()}"]
+
+
+class Histogram():
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: list[float] = UPSTREAM_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        with self.lock:
+            # Per label set: count per bucket (last one is +Inf), sum
+            counts, total = self.values.get(
+                labels, [[0] * (len(self.buckets) + 1), 0])
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels] = [counts, total + value]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bucket, count in zip(self.buckets + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(
+                        f"{self.name}_bucket{format_labels(self.labels, labels, f'le="{bucket}"')} {cumulative}")
+                lines.append(
+                    f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+                lines.append(
+                    f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class StageTimer():
+    # Adds up the time a job spends in each stage of its pipeline. Stages are nested
+    # generators, so only the time spent in a stage itself is counted, not in the ones it pulls from
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+        self.stack: list[list] = []
+
+    def enter(self, stage: str) -> None:
+        self.stack.append([stage, perf_counter(), 0.0])
+
+    def exit(self) -> None:
+        stage, start, children = self.stack.pop()
+        elapsed = perf_counter() - start
+        self.durations[stage] = self.durations.get(
+            stage, 0.0) + elapsed - children
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def wrap(self, stage: str, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def observe(self, histogram: Histogram) -> None:
+        for stage, duration in self.durations.items():
+            histogram.observe(duration, stage)
+
+
+esp_request_seconds = Histogram(
+    "esp_request_seconds", "Latency of ESP API calls", ("call", "tenant"))
+esp_errors_total = Counter(
+    "esp_errors_total", "ESP API calls that failed or returned an error status", ("call", "tenant", "status"))
+job_stage_seconds = Histogram(
+    "job_stage_seconds", "Time jobs spend in each pipeline stage", ("stage",), STAGE_BUCKETS)
+jobs_total = Counter("jobs_total", "Finished jobs by kind and status",
+                     ("kind", "status"))
@@ -0,0 +1,92 @@
+import asyncio
+import heapq
+import itertools
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Lower runs first, so scheduled PBI and survey jobs go ahead of ad-hoc reporting jobs
+PRIORITY_SCHEDULED = 0
+PRIORITY_MANUAL = 1
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Scheduler():
+    # Runs jobs on a bounded pool, highest priority first, with at most tenant_limit jobs
+    # per tenant at the same time. All bookkeeping happens on the event loop, so no locks
+    def __init__(self, workers: int, max_queue: int, tenant_limit: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.tenant_limit = tenant_limit
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job")
+        self.queue: list[tuple[int, int, dict]] = []
+        self.counter = itertools.count()
+        self.running: dict[str, int] = {}
+        self.active = 0
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(self, job_id: str, tenant: str | None, priority: int, func: Callable, *args) -> None:
+        # Each priority class has its own share of the queue, so a burst of manual jobs can't keep scheduled ones out
+        if sum(1 for item in self.queue if item[0] == priority) >= self.max_queue:
+            raise QueueFull(f"Job queue is full ({self.max_queue} jobs)")
+        entry = {"job_id": job_id, "tenant": tenant,
+                 "func": func, "args": args}
+        heapq.heappush(self.queue, (priority, next(self.counter), entry))
+        print(f"[{job_id}] Queued with priority {priority}, queue depth: {len(self.queue)}")
+        self.dispatch()
+
+    def cancel(self, job_id: str) -> bool:
+        for index, (_, _, entry) in enumerate(self.queue):
+            if entry["job_id"] == job_id:
+                self.queue.pop(index)
+                heapq.heapify(self.queue)
+                return True
+        return False
+
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def dispatch(self) -> None:
+        while self.active < self.workers:
+            entry = self.next_entry()
+            if entry is None:
+                return
+            self.active += 1
+            if entry["tenant"] is not None:
+                self.running[entry["tenant"]] = self.running.get(
+                    entry["tenant"], 0) + 1
+            task = asyncio.get_running_loop().create_task(self.run(entry))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def next_entry(self) -> dict | None:
+        # Highest priority job whose tenant is still under its limit
+        for item in sorted(self.queue):
+            entry = item[2]
+            if entry["tenant"] is None or self.running.get(entry["tenant"], 0) < self.tenant_limit:
+                self.queue.remove(item)
+                heapq.heapify(self.queue)
+                return entry
+        return None
+
+    async def run(self, entry: dict) -> None:
+        try:
+            if asyncio.iscoroutinefunction(entry["func"]):
+                await entry["func"](*entry["args"])
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.executor, partial(entry["func"], *entry["args"]))
+        except Exception as e:
+            print(f"[{entry['job_id']}] Job crashed: {e}")
+        finally:
+            self.active -= 1
+            if entry["tenant"] is not None:
+                self.running[entry["tenant"]] -= 1
+            self.dispatch()
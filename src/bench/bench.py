@@ -0,0 +1,278 @@
+import os
+import sys
+import csv
+import json
+import math
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from functools import partial
+from time import perf_counter, sleep
+from datetime import date, timedelta
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+# End-to-end benchmark of the API against the mock ESP server, both started as uvicorn processes:
+#   python bench.py --jobs 8 --latency 0.05 --interactions 2000
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+API_KEY = "bench"
+TENANTS = ["tenant1", "tenant2", "tenant3", "tenant4",
+           "devdev", "tenant1dev", "tenant2dev", "tenant3dev", "tenant4dev"]
+RESOURCES = ["configuration", "variables", "localization", "kb_support"]
+POLL_INTERVAL = 0.2
+
+
+class RssSampler():
+    # Peak resident memory of a process, sampled from /proc so it can be reset between scenarios
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def rss(self) -> int:
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def start(self) -> None:
+        self.peak = self.rss()
+        self.thread.start()
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def start_server(module: str, port: int, cwd: str, env: dict, log: str) -> subprocess.Popen:
+    with open(log, "w") as f:
+        process = subprocess.Popen([sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning"],
+                                   cwd=cwd, env=env, stdout=f, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}/"
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError(f"{module} exited, see {log}")
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.ConnectionError:
+            sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{module} did not start, see {log}")
+
+
+def wait_for_job(api: str, job_id: str) -> str:
+    while True:
+        response = requests.get(f"{api}/reporting/job_status/{job_id}/",
+                                headers={"x-api-key": API_KEY})
+        if response.status_code == 404:
+            return "deleted"
+        status = response.json()["status"]
+        if status not in ["queued", "processing"]:
+            return status
+        sleep(POLL_INTERVAL)
+
+
+def count_rows(response: requests.Response) -> int:
+    # CSV results, minus the header. Transcripts span several lines, so records are counted by csv
+    response.encoding = "utf-8"
+    return max(0, sum(1 for _ in csv.reader(response.iter_lines(decode_unicode=True))) - 1)
+
+
+def reporting_job(api: str, index: int, columns: list[str] | None = None) -> int:
+    headers = {"x-api-key": API_KEY}
+    body = {"tenant": TENANTS[index % len(TENANTS)], "filter": {"createdDateRange": [
+        f"{date.today() - timedelta(days=30)}", f"{date.today() + timedelta(days=1)}"]}}
+    if columns:
+        body["columns"] = columns
+    response = requests.post(f"{api}/reporting/start_job/", headers=headers, json=body)
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    status = wait_for_job(api, job_id)
+    if status == "deleted":
+        return 0
+    response = requests.get(
+        f"{api}/reporting/download/{job_id}/", headers=headers, stream=True)
+    response.raise_for_status()
+    return count_rows(response)
+
+
+def pbi_job(api: str, index: int) -> int:
+    # One incremental run per tenant, a second one for the same tenant would attach to the running one
+    headers = {"x-api-key": API_KEY}
+    tenant = TENANTS[index % len(TENANTS)]
+    response = requests.post(f"{api}/pbi/start_job/",
+                             headers=headers, json={"tenant": tenant})
+    response.raise_for_status()
+    wait_for_job(api, response.json()["job_id"])
+    response = requests.get(f"{api}/pbi/download/", headers=headers,
+                            json={"tenant": tenant}, stream=True)
+    if response.status_code == 404:
+        return 0
+    response.raise_for_status()
+    return count_rows(response)
+
+
+def export_request(api: str, index: int) -> int:
+    response = requests.post(f"{api}/exporting/{RESOURCES[index % len(RESOURCES)]}/", headers={"x-api-key": API_KEY},
+                             json={"tenant": TENANTS[index % len(TENANTS)], "format": "csv"}, stream=True)
+    response.raise_for_status()
+    return count_rows(response)
+
+
+def run_scenario(name: str, func: Callable[[str, int], int], api: str, count: int, concurrency: int, pid: int) -> dict:
+    latencies = []
+    rows = 0
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(index: int) -> None:
+        nonlocal rows, errors
+        start = perf_counter()
+        try:
+            result = func(api, index)
+        except Exception as e:
+            print(f"{name} #{index} failed: {e}")
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append(perf_counter() - start)
+            rows += result
+
+    sampler = RssSampler(pid)
+    sampler.start()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(count)))
+    elapsed = perf_counter() - start
+    peak_rss = sampler.stop()
+
+    return {
+        "scenario": name,
+        "operations": count,
+        "errors": errors,
+        "seconds": elapsed,
+        "ops_per_second": len(latencies) / elapsed,
+        "rows_per_second": rows / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_rss_mib": peak_rss / 1024 / 1024
+    }
+
+
+def print_results(results: list[dict]) -> None:
+    print(f"{'scenario':<12}{'ops':>6}{'errors':>8}{'seconds':>10}{'ops/s':>9}{'rows/s':>11}{'p50 s':>9}{'p99 s':>9}{'peak RSS MiB':>14}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['operations']:>6}{r['errors']:>8}{r['seconds']:>10.2f}{r['ops_per_second']:>9.2f}"
+              f"{r['rows_per_second']:>11.1f}{r['p50']:>9.3f}{r['p99']:>9.3f}{r['peak_rss_mib']:>14.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API against the mock ESP server")
+    parser.add_argument("--scenarios", default="reporting,pbi,exporting",
+                        help="comma separated, from reporting, pbi and exporting")
+    parser.add_argument("--jobs", type=int, default=8,
+                        help="reporting jobs to run, PBI jobs are one per tenant up to this")
+    parser.add_argument("--requests", type=int, default=40,
+                        help="export requests to make")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="clients running at the same time")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="average ESP latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="share of ESP calls answered with a 503")
+    parser.add_argument("--interactions", type=int, default=2000,
+                        help="interactions returned by GraphQL")
+    parser.add_argument("--messages", type=int, default=20,
+                        help="messages per conversation")
+    parser.add_argument("--config-items", type=int, default=1000,
+                        help="items per configuration resource")
+    parser.add_argument("--columns",
+                        help="comma separated columns for reporting jobs, all of them by default")
+    parser.add_argument("--cold", action="store_true",
+                        help="disable the transcript cache")
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--esp-port", type=int, default=8101)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    esp_env = {
+        **os.environ,
+        "MOCK_LATENCY": str(args.latency),
+        "MOCK_ERROR_RATE": str(args.error_rate),
+        "MOCK_INTERACTIONS": str(args.interactions),
+        "MOCK_MESSAGES": str(args.messages),
+        "MOCK_CONFIG_ITEMS": str(args.config_items)
+    }
+    app_env = {
+        **os.environ,
+        "API_KEY": API_KEY,
+        "CREDS": "bench||bench",
+        "SMTP_CONN": "127.0.0.1:25",
+        "SMTP_CREDS": "bench||bench",
+        "MAIL_TO": "bench@localhost",
+        "ESP_URL": f"http://127.0.0.1:{args.esp_port}/{{tenant}}",
+        "JOB_DIR": os.path.join(workdir, "jobs"),
+        "CACHE_DIR": os.path.join(workdir, "cache")
+    }
+    if args.cold:
+        app_env["TRANSCRIPT_CACHE_MAX_BYTES"] = "0"
+    print(f"Logs and job files in {workdir}")
+
+    esp = start_server("mock_esp:app", args.esp_port, BENCH_DIR,
+                       esp_env, os.path.join(workdir, "esp.log"))
+    try:
+        app = start_server("main:app", args.app_port, APP_DIR,
+                           app_env, os.path.join(workdir, "app.log"))
+        try:
+            api = f"http://127.0.0.1:{args.app_port}"
+            scenarios = {
+                "reporting": (partial(reporting_job, columns=args.columns and args.columns.split(",")), args.jobs),
+                "pbi": (pbi_job, min(args.jobs, len(TENANTS))),
+                "exporting": (export_request, args.requests)
+            }
+            results = []
+            for name in args.scenarios.split(","):
+                func, count = scenarios[name]
+                print(f"Running {name}: {count} operations...")
+                results.append(run_scenario(
+                    name, func, api, count, args.concurrency, app.pid))
+        finally:
+            app.terminate()
+            app.wait()
+    finally:
+        esp.terminate()
+        esp.wait()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
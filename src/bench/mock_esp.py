@@ -0,0 +1,211 @@
+import os
+import re
+import random
+import asyncio
+import itertools
+from datetime import date, datetime, timedelta, timezone
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+
+# Local stand-in for the ESP API, run with ESP_URL=http://127.0.0.1:{port}/{tenant} on the app side:
+#   uvicorn mock_esp:app --port 8001
+# Average latency per call in seconds, share of calls answered with a 503, and dataset size
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0.05"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_INTERACTIONS = int(os.getenv("MOCK_INTERACTIONS", "2000"))
+# Interactions are spread evenly over the last MOCK_DAYS days
+MOCK_DAYS = int(os.getenv("MOCK_DAYS", "30"))
+MOCK_MESSAGES = int(os.getenv("MOCK_MESSAGES", "20"))
+MOCK_CONFIG_ITEMS = int(os.getenv("MOCK_CONFIG_ITEMS", "1000"))
+# Seconds until an async report9_data export is ready
+MOCK_EXPORT_SECONDS = float(os.getenv("MOCK_EXPORT_SECONDS", "3"))
+
+CONFIG_RESOURCES = {
+    "config/v0.1/configuration/": "configuration",
+    "chatbot/v0.1/variables/": "variables",
+    "common/v0.1/localization": "localization",
+    "chatbot/v0.1/kb_support/": "kb_support"
+}
+
+app = FastAPI()
+exports: dict[int, float] = {}
+export_ids = itertools.count(1)
+started = datetime.now(timezone.utc)
+
+
+async def simulate(request: Request) -> None:
+    # Exponential latency around MOCK_LATENCY, with a random share of calls failing
+    if MOCK_LATENCY > 0:
+        await asyncio.sleep(random.expovariate(1 / MOCK_LATENCY))
+    if random.random() < MOCK_ERROR_RATE:
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    if not request.headers.get("Authorization", "").startswith("Token "):
+        raise HTTPException(
+            status_code=401, detail="Authentication credentials were not provided.")
+
+
+def interaction(tenant: str, index: int) -> dict:
+    # Two interactions per conversation, one in three of them not deflected
+    created = created_at(index)
+    return {
+        "creation": {"date": created.isoformat()},
+        "eid": f"{tenant}-{index}",
+        "interactionText": f"Interaction {index}",
+        "cleanInteractionText": f"interaction {index}",
+        "noResponse": False,
+        "userName": f"User {index % 50}",
+        "userJobRole": "Engineer",
+        "userDepartment": "IT",
+        "userLocation": "Remote",
+        "city": "Gdansk",
+        "state": None,
+        "country": "Poland",
+        "matchedArchetypeIntent": f"intent_{index % 20}",
+        "actualMatchedIntent": f"intent_{index % 20}",
+        "actualMatchedApplication": "it",
+        "actualMatchedApplicationType": "service",
+        "intentReviewed": False,
+        "source": "chat",
+        "caseReference": None,
+        "espServiceDepartment": "IT",
+        "espCategory": "Hardware",
+        "espServiceTeam": "Service Desk",
+        "serviceDepartment": "IT",
+        "serviceDepartmentClassification": "IT",
+        "helpfulFeedback": None,
+        "taskFeedback": None,
+        "supportFeedback": None,
+        "deflected": index % 3 != 0,
+        "possiblyAbandoned": False,
+        "channel": "web",
+        "os": "Windows",
+        "client": "browser",
+        "isoCountryCode": "PL",
+        "conversationChannel": f"{index // 2}",
+        "kbResponse": None,
+        "userLanguage": "en",
+        "actualMatchedIntentReportingLabel": f"Intent {index % 20}",
+        "matchedArchetypeIntentReportingLabel": f"Intent {index % 20}",
+        "severity": "low",
+        "keywords": ["laptop"],
+        "automationStatus": None
+    }
+
+
+def created_at(index: int) -> datetime:
+    return started - timedelta(days=MOCK_DAYS) * (1 - index / MOCK_INTERACTIONS)
+
+
+def in_range(index: int, date_range: list | None) -> bool:
+    # createdDateRange as [start, end) dates
+    if not date_range:
+        return True
+    created = created_at(index).date()
+    return date.fromisoformat(date_range[0][:10]) <= created < date.fromisoformat(date_range[1][:10])
+
+
+def message(conversation: int, index: int) -> dict:
+    # Bot, user and the occasional live agent (user_id 22) take turns
+    user_id = [1, 1000 + conversation % 50, 1, 22][index % 4]
+    created = started - timedelta(days=1, minutes=MOCK_MESSAGES - index)
+    return {
+        "id": conversation * 1000 + index,
+        "type": "message",
+        "user_id": user_id,
+        "text": f"Message {index} of conversation {conversation}",
+        "created": created.isoformat(),
+        "sys_date_created": created.isoformat()
+    }
+
+
+@app.post("/{tenant}/api/authentication/auth/login/")
+async def login(tenant: str, request: Request) -> dict:
+    body = await request.json()
+    if not body.get("username") or not body.get("password"):
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    return {"key": f"{tenant}-{random.getrandbits(64):x}"}
+
+
+@app.post("/{tenant}/api/graph/")
+async def graphql(tenant: str, request: Request) -> dict:
+    await simulate(request)
+    body = await request.json()
+    variables = body["variables"]
+    # Like ESP, only the fields named in the query are returned
+    selected = set(re.findall(r"\w+", body["query"]))
+    date_range = variables["interactionFilter"].get("createdDateRange")
+    matching = [i for i in range(MOCK_INTERACTIONS) if in_range(i, date_range)]
+    # Cursors are positions in the filtered interactions
+    start = int(variables.get("after") or 0)
+    end = min(start + (variables.get("first") or len(matching)), len(matching))
+    return {"interactions": {
+        "pageInfo": {
+            "hasNextPage": end < len(matching),
+            "hasPreviousPage": start > 0,
+            "startCursor": str(start),
+            "endCursor": str(end)
+        },
+        "channelCounts": [{"name": "web", "count": len(matching)}],
+        "edges": [{"node": {field: value for field, value in interaction(tenant, i).items() if field in selected}}
+                  for i in matching[start:end]],
+        "keywordCounts": [{"name": "laptop", "count": len(matching)}]
+    }}
+
+
+@app.get("/{tenant}/api/chat/v0.1/admin_channels/{conversation_id}/messages/")
+async def messages(tenant: str, conversation_id: int, request: Request, limit: int = 100) -> dict:
+    await simulate(request)
+    # Newest message first, like ESP
+    results = [message(conversation_id, i)
+               for i in reversed(range(MOCK_MESSAGES))]
+    return {"count": MOCK_MESSAGES, "next": None, "previous": None, "results": results[:limit]}
+
+
+@app.get("/{tenant}/api/espuser/v0.1/users/{user_id}/")
+async def user(tenant: str, user_id: int, request: Request) -> dict:
+    await simulate(request)
+    return {"id": user_id, "full_name": f"User {user_id % 50}"}
+
+
+@app.get("/{tenant}/api/chatbot/v0.1/report9_data/csv/")
+async def start_export(tenant: str, request: Request) -> dict:
+    await simulate(request)
+    export_id = next(export_ids)
+    exports[export_id] = asyncio.get_running_loop().time() + MOCK_EXPORT_SECONDS
+    status_url = f"{request.base_url}{tenant}/api/chatbot/v0.1/report9_data/export/{export_id}/?source=report9"
+    return {"status": "queued", "url": status_url}
+
+
+@app.get("/{tenant}/api/chatbot/v0.1/report9_data/export/{export_id}/")
+async def export_status(tenant: str, export_id: int, request: Request) -> dict:
+    await simulate(request)
+    if export_id not in exports:
+        raise HTTPException(status_code=404, detail="Not found.")
+    if asyncio.get_running_loop().time() < exports[export_id]:
+        return {"status": "processing", "sys_custom_fields": {}}
+    file = f"{request.base_url}{tenant}/api/chatbot/v0.1/report9_data/file/{export_id}/"
+    return {"status": "completed", "sys_custom_fields": {"file": file}}
+
+
+@app.get("/{tenant}/api/chatbot/v0.1/report9_data/file/{export_id}/")
+async def export_file(tenant: str, export_id: int, request: Request) -> Response:
+    await simulate(request)
+    lines = ["conversation_channel,sys_date_created,interaction_text,live_chat_interaction_feedback"]
+    for i in range(MOCK_INTERACTIONS // 10):
+        lines.append(f"{i},{started.isoformat()},Interaction {i},Helpful")
+    return Response("\n".join(lines) + "\n", media_type="text/csv")
+
+
+@app.get("/{tenant}/api/{path:path}")
+async def config(tenant: str, path: str, request: Request, limit: int = 200, offset: int = 0) -> JSONResponse:
+    if path not in CONFIG_RESOURCES:
+        raise HTTPException(status_code=404, detail="Not found.")
+    await simulate(request)
+    resource = CONFIG_RESOURCES[path]
+    end = min(offset + limit, MOCK_CONFIG_ITEMS)
+    results = [{"id": i, "name": f"{resource}_{i}", "value": f"Value {i}", "tenant": tenant}
+               for i in range(offset, end)]
+    next_url = None
+    if end < MOCK_CONFIG_ITEMS:
+        next_url = f"{request.base_url}{tenant}/api/{path}?limit={limit}&offset={end}&format=json"
+    return JSONResponse({"count": MOCK_CONFIG_ITEMS, "next": next_url, "previous": None, "results": results})